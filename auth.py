@@ -1,45 +1,149 @@
+import asyncio
+import hashlib
+import secrets
+import time
+import uuid
 from datetime import datetime, timedelta
 from typing import Optional
 from jose import JWTError, jwt
-from passlib.context import CryptContext
 from fastapi import Depends, HTTPException, status
-from fastapi.security import HTTPBearer, HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from database import get_db
-from models import User, Token
+from fastapi.security import APIKeyHeader, HTTPBearer, HTTPAuthorizationCredentials
+from sqlalchemy import delete, select, update
+from sqlalchemy.ext.asyncio import AsyncSession
+import database
+from database import get_db, session_scope
+from models import User, Token, RefreshToken
 from schemas import TokenData, UserLogin
+from cache import TTLCache
+import hashing
+import timing
 import os
-from dotenv import load_dotenv
-
-# Load environment variables
-load_dotenv()
 
 # Security configuration
 SECRET_KEY = os.getenv("SECRET_KEY", "your-secret-key-change-this-in-production")
 ALGORITHM = "HS256"
 ACCESS_TOKEN_EXPIRE_MINUTES = 30
+# Refresh tokens are rotated on every use; a session ends after this many idle days
+REFRESH_TOKEN_EXPIRE_DAYS = int(os.getenv("REFRESH_TOKEN_EXPIRE_DAYS", "14"))
+
+# "stateful" records every token's jti in the tokens table; "stateless" skips
+# the table and checks the token_version claim against User.token_version
+TOKEN_MODE = os.getenv("TOKEN_MODE", "stateful").lower()
+
+# Expired rows are removed from the tokens and refresh_tokens tables in batches by a background task
+TOKEN_PURGE_INTERVAL_SECONDS = int(os.getenv("TOKEN_PURGE_INTERVAL_SECONDS", "600"))
+TOKEN_PURGE_BATCH_SIZE = int(os.getenv("TOKEN_PURGE_BATCH_SIZE", "1000"))
 
-# Password hashing
-pwd_context = CryptContext(schemes=["bcrypt"], deprecated="auto")
+# Password hashing (runs in the hashing worker pool)
+pwd_context = hashing.pwd_context
+
+# POST /users/bulk is for partner/admin tooling: callers must also send this
+# key in X-API-Key. Unset, the endpoint is disabled.
+BULK_CREATE_API_KEY = os.getenv("BULK_CREATE_API_KEY", "")
 
 # Bearer token scheme
 security = HTTPBearer()
+# For dependencies that only peek at the token and leave rejecting it to get_current_user
+optional_security = HTTPBearer(auto_error=False)
+bulk_api_key_header = APIKeyHeader(name="X-API-Key", auto_error=False)
+
+# Authenticated-principal cache: token digest -> detached User snapshot.
+# The TTL bounds how long a logout or profile change made by another
+# worker process can go unnoticed; AUTH_CACHE_TTL=0 disables the cache.
+AUTH_CACHE_TTL = float(os.getenv("AUTH_CACHE_TTL", "60"))
+AUTH_CACHE_SIZE = int(os.getenv("AUTH_CACHE_SIZE", "10000"))
+
+# user id -> token digests cached for that user
+_principal_keys = {}
+
+def _forget_principal(key: str, user: User):
+    keys = _principal_keys.get(user.id)
+    if keys is not None:
+        keys.discard(key)
+        if not keys:
+            _principal_keys.pop(user.id, None)
+
+principal_cache = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL, on_evict=_forget_principal)
+
+# Recent revocations, so a request that read the database just before a
+# logout commits doesn't cache the stale principal afterwards:
+# token digest -> True, and user id -> monotonic time of the last invalidation
+_revoked_tokens = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+_invalidated_users = TTLCache(AUTH_CACHE_SIZE, AUTH_CACHE_TTL)
+
+def token_digest(token: str) -> str:
+    """Fixed-width digest of a token, used as a cache key"""
+    return hashlib.sha256(token.encode()).hexdigest()
+
+def _snapshot(user: User) -> User:
+    """Copy a user's column values into a new, session-less User"""
+    return User(**{column.key: getattr(user, column.key) for column in User.__table__.columns})
 
-def verify_password(plain_password: str, hashed_password: str) -> bool:
-    """Verify a password against its hash"""
-    return pwd_context.verify(plain_password, hashed_password)
+def cache_principal(token: str, user: User, resolved_at: float) -> User:
+    """Remember the user resolved for a token.
 
-def get_password_hash(password: str) -> str:
-    """Hash a password"""
-    return pwd_context.hash(password)
+    resolved_at is the time.monotonic() from before the database reads; the
+    entry is skipped if the token or user was invalidated since then.
+    """
+    principal = _snapshot(user)
+    key = token_digest(token)
+    if _revoked_tokens.get(key) is not None:
+        return principal
+    invalidated_at = _invalidated_users.get(principal.id)
+    if invalidated_at is not None and invalidated_at >= resolved_at:
+        return principal
+    principal_cache.set(key, principal)
+    _principal_keys.setdefault(principal.id, set()).add(key)
+    return principal
 
-def authenticate_user(db: Session, username: str, password: str) -> Optional[User]:
+def invalidate_token(token: str):
+    """Drop the cached principal for a single token"""
+    key = token_digest(token)
+    _revoked_tokens.set(key, True)
+    user = principal_cache.pop(key)
+    if user is not None:
+        _forget_principal(key, user)
+
+def invalidate_user(user_id: int):
+    """Drop every cached principal of a user after it changed"""
+    _invalidated_users.set(user_id, time.monotonic())
+    for key in _principal_keys.pop(user_id, set()):
+        principal_cache.pop(key)
+    # Replicas may still have the old row; read this user's requests from the primary
+    database.mark_written(user_id)
+
+async def verify_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against its hash (raises hashing.PoolBusy when the pool is saturated)"""
+    return await hashing.run_in_pool(hashing.check_password, plain_password, hashed_password, admission=True)
+
+async def verify_and_update_password(plain_password: str, hashed_password: str):
+    """Like verify_password, also returning a replacement hash when the stored one is outdated"""
+    return await hashing.run_in_pool(
+        hashing.check_and_update_password, plain_password, hashed_password, admission=True
+    )
+
+async def get_password_hash(password: str, admission: bool = False, bulk: bool = False) -> str:
+    """Hash a password; admission=True raises hashing.PoolBusy when the pool is saturated,
+    bulk=True queues on the bulk workers instead"""
+    return await hashing.run_in_pool(hashing.hash_password, password, admission=admission, bulk=bulk)
+
+async def authenticate_user(db: AsyncSession, username: str, password: str) -> Optional[User]:
     """Authenticate a user with username and password"""
-    user = db.query(User).filter(User.username == username).first()
+    user = await db.scalar(select(User).where(User.username == username))
     if not user:
         return None
-    if not verify_password(password, user.password):
+    verified, new_hash = await verify_and_update_password(password, user.password)
+    if not verified:
         return None
+    if new_hash:
+        # Hashed with an old scheme or cost: upgrade it while the password is at hand
+        await db.execute(
+            update(User)
+            .where(User.id == user.id, User.password == user.password)
+            .values(password=new_hash)
+            .execution_options(synchronize_session=False)
+        )
+        await db.commit()
     return user
 
 def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
@@ -49,7 +153,7 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None):
         expire = datetime.utcnow() + expires_delta
     else:
         expire = datetime.utcnow() + timedelta(minutes=15)
-    to_encode.update({"exp": expire})
+    to_encode.update({"exp": expire, "jti": uuid.uuid4().hex})
     encoded_jwt = jwt.encode(to_encode, SECRET_KEY, algorithm=ALGORITHM)
     return encoded_jwt
 
@@ -59,16 +163,48 @@ def verify_token(token: str) -> Optional[TokenData]:
         payload = jwt.decode(token, SECRET_KEY, algorithms=[ALGORITHM])
         username: str = payload.get("sub")
         user_id: int = payload.get("user_id")
-        if username is None or user_id is None:
+        jti: str = payload.get("jti")
+        if username is None or user_id is None or jti is None:
             return None
-        token_data = TokenData(username=username, user_id=user_id)
+        token_data = TokenData(
+            username=username,
+            user_id=user_id,
+            jti=jti,
+            token_version=payload.get("token_version")
+        )
         return token_data
     except JWTError:
         return None
 
-def get_current_user(
+def require_bulk_api_key(api_key: Optional[str] = Depends(bulk_api_key_header)):
+    """Reject bulk creation unless X-API-Key matches BULK_CREATE_API_KEY"""
+    if not BULK_CREATE_API_KEY:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Bulk creation is disabled")
+    if api_key is None or not secrets.compare_digest(api_key, BULK_CREATE_API_KEY):
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Invalid API key")
+
+async def get_read_db(
+    credentials: Optional[HTTPAuthorizationCredentials] = Depends(optional_security),
+    db: AsyncSession = Depends(get_db)
+):
+    """Session for read-only work: a replica, unless the caller wrote recently.
+
+    Without replicas (or inside the caller's read-your-writes window) this is
+    the request's primary session, so no second connection is opened.
+    """
+    if not database.REPLICA_URLS:
+        yield db
+        return
+    token_data = verify_token(credentials.credentials) if credentials else None
+    if database.wrote_recently(token_data.user_id if token_data else None):
+        yield db
+        return
+    async with session_scope(read_only=True) as replica:
+        yield replica
+
+async def get_current_user(
     credentials: HTTPAuthorizationCredentials = Depends(security),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ) -> User:
     """Get the current authenticated user from the token"""
     credentials_exception = HTTPException(
@@ -77,37 +213,173 @@ def get_current_user(
         headers={"WWW-Authenticate": "Bearer"},
     )
     
-    try:
-        token = credentials.credentials
-        token_data = verify_token(token)
-        if token_data is None:
-            raise credentials_exception
+    with timing.measure_auth():
+        try:
+            token = credentials.credentials
+            token_data = verify_token(token)
+            if token_data is None:
+                raise credentials_exception
         
-        # Check if token exists in database (not deleted)
-        db_token = db.query(Token).filter(Token.token == token).first()
-        if not db_token:
-            raise credentials_exception
+            principal = principal_cache.get(token_digest(token))
+            if principal is not None:
+                return principal
+
+            resolved_at = time.monotonic()
+            if TOKEN_MODE != "stateless":
+                # Check if token exists in database (not deleted)
+                db_token = await db.get(Token, token_data.jti)
+                if not db_token or db_token.user_id != token_data.user_id:
+                    raise credentials_exception
             
-        user = db.query(User).filter(User.username == token_data.username).first()
-        if user is None:
+            # By id: a username can be given up and taken by another user
+            user = await db.get(User, token_data.user_id)
+            if user is None:
+                raise credentials_exception
+            if TOKEN_MODE == "stateless" and token_data.token_version != user.token_version:
+                raise credentials_exception
+            return cache_principal(token, user, resolved_at)
+        except Exception:
             raise credentials_exception
-        return user
-    except Exception:
-        raise credentials_exception
 
-def store_token(db: Session, user_id: int, token: str):
-    """Store a token in the database (for potential blacklisting)"""
-    db_token = Token(token=token, user_id=user_id)
+async def store_token(db: AsyncSession, user_id: int, token: str):
+    """Record a token's jti in the database (for potential blacklisting)"""
+    claims = jwt.get_unverified_claims(token)
+    db_token = Token(
+        jti=claims["jti"],
+        user_id=user_id,
+        family_id=claims.get("sid"),
+        expires_at=datetime.utcfromtimestamp(claims["exp"])
+    )
     db.add(db_token)
-    db.commit()
-    db.refresh(db_token)
+    await db.commit()
+    # Replicas may not have the token yet
+    database.mark_written(user_id)
     return db_token
 
-def delete_token(db: Session, token: str):
-    """Delete a token from the database"""
-    db_token = db.query(Token).filter(Token.token == token).first()
-    if db_token:
-        db.delete(db_token)
-        db.commit()
-        return True
-    return False 
\ No newline at end of file
+async def delete_token(db: AsyncSession, token: str):
+    """Delete a token, and the refresh tokens of its login session, from the database"""
+    invalidate_token(token)
+    claims = jwt.get_unverified_claims(token)
+    result = await db.execute(delete(Token).where(Token.jti == claims.get("jti")))
+    if claims.get("sid"):
+        await db.execute(delete(RefreshToken).where(RefreshToken.family_id == claims["sid"]))
+    await db.commit()
+    database.mark_written(claims.get("user_id"))
+    return result.rowcount > 0
+
+async def revoke_all_tokens(db: AsyncSession, user_id: int):
+    """Revoke every token of a user by bumping their token version"""
+    await db.execute(
+        update(User)
+        .where(User.id == user_id)
+        .values(token_version=User.token_version + 1)
+        .execution_options(synchronize_session=False)
+    )
+    await db.execute(delete(Token).where(Token.user_id == user_id))
+    await db.execute(delete(RefreshToken).where(RefreshToken.user_id == user_id))
+    await db.commit()
+    invalidate_user(user_id)
+
+async def issue_session_tokens(db: AsyncSession, user: User, family_id: Optional[str] = None) -> dict:
+    """Create an access token and a refresh token for a user and commit them.
+
+    family_id continues an existing login session (a refresh); without it a
+    new session starts. The access token's sid claim names the session.
+    """
+    family_id = family_id or uuid.uuid4().hex
+    access_token = create_access_token(
+        data={"sub": user.username, "user_id": user.id, "token_version": user.token_version, "sid": family_id},
+        expires_delta=timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
+    )
+    refresh_token = secrets.token_urlsafe(32)
+    db.add(RefreshToken(
+        token_hash=token_digest(refresh_token),
+        family_id=family_id,
+        user_id=user.id,
+        token_version=user.token_version,
+        expires_at=datetime.utcnow() + timedelta(days=REFRESH_TOKEN_EXPIRE_DAYS)
+    ))
+    if TOKEN_MODE != "stateless":
+        # Commits the refresh token too
+        await store_token(db, user.id, access_token)
+    else:
+        await db.commit()
+    return {
+        "access_token": access_token,
+        "refresh_token": refresh_token,
+        "token_type": "bearer",
+        "user_id": user.id,
+        "username": user.username
+    }
+
+async def rotate_refresh_token(db: AsyncSession, refresh_token: str) -> dict:
+    """Exchange a refresh token for new session tokens, without a password check.
+
+    Each refresh token works once. Presenting one that was already used means
+    it leaked (or a client replayed it), so the whole session is revoked.
+    """
+    refresh_exception = HTTPException(
+        status_code=status.HTTP_401_UNAUTHORIZED,
+        detail="Invalid or expired refresh token",
+        headers={"WWW-Authenticate": "Bearer"},
+    )
+    now = datetime.utcnow()
+    db_token = await db.get(RefreshToken, token_digest(refresh_token))
+    if db_token is None or db_token.expires_at < now:
+        raise refresh_exception
+    family_id, user_id, token_version = db_token.family_id, db_token.user_id, db_token.token_version
+
+    # Claim the token; of two concurrent refreshes with it, only one updates the row
+    claimed = await db.execute(
+        update(RefreshToken)
+        .where(RefreshToken.token_hash == db_token.token_hash, RefreshToken.used_at.is_(None))
+        .values(used_at=now)
+        .execution_options(synchronize_session=False)
+    )
+    if claimed.rowcount != 1:
+        if TOKEN_MODE == "stateless":
+            # Stateless access tokens can only be revoked all together
+            await revoke_all_tokens(db, user_id)
+        else:
+            await db.execute(delete(RefreshToken).where(RefreshToken.family_id == family_id))
+            await db.execute(delete(Token).where(Token.family_id == family_id))
+            await db.commit()
+            invalidate_user(user_id)
+        print(f"WARNING: refresh token reused; revoked session {family_id} of user {user_id}")
+        raise refresh_exception
+
+    user = await db.get(User, user_id)
+    # Revoked by logout-all since it was issued, or the user was deleted and the
+    # id reused (SQLite hands out the highest deleted id again)
+    if user is None or user.token_version != token_version or user.created_at > db_token.created_at:
+        await db.commit()
+        raise refresh_exception
+    return await issue_session_tokens(db, user, family_id)
+
+async def purge_expired_tokens(db: AsyncSession, batch_size: int = TOKEN_PURGE_BATCH_SIZE) -> int:
+    """Delete expired access and refresh token rows in batches, returning how many were removed"""
+    purged = 0
+    now = datetime.utcnow()
+    for key, expires_at in ((Token.jti, Token.expires_at), (RefreshToken.token_hash, RefreshToken.expires_at)):
+        while True:
+            result = await db.scalars(select(key).where(expires_at < now).limit(batch_size))
+            keys = result.all()
+            if not keys:
+                break
+            await db.execute(delete(key.table).where(key.in_(keys)))
+            await db.commit()
+            purged += len(keys)
+            if len(keys) < batch_size:
+                break
+    return purged
+
+async def purge_expired_tokens_forever():
+    """Background task: purge expired tokens every TOKEN_PURGE_INTERVAL_SECONDS"""
+    while True:
+        # Sleep first so startup does not open a database connection
+        await asyncio.sleep(TOKEN_PURGE_INTERVAL_SECONDS)
+        try:
+            async with session_scope() as db:
+                await purge_expired_tokens(db)
+        except Exception as e:
+            print(f"WARNING: token purge failed: {e}")
@@ -0,0 +1,236 @@
+#!/usr/bin/env python3
+"""
+Throughput and latency of the main endpoints under concurrent load
+
+Boots the app in-process (ASGI, no network) against a temporary, migrated
+SQLite database, or --database-url, seeds users directly in the database
+(one bcrypt hash shared by all of them), then runs each scenario with
+--concurrency clients:
+
+    login   POST /auth/login (bcrypt verify)
+    refresh POST /auth/refresh, each client rotating its own refresh token
+    list    GET /users/?limit=20
+    get     GET /users/{id}
+    patch   PATCH /users/{id} on the client's own user
+    delete  DELETE /users/{id}, each request on a different user
+
+Every client owns one seeded user and authenticates with its token.
+
+Usage: python -m benchmarks.load [--users 500] [--concurrency 20] [--requests 500]
+Prints one JSON document with requests/s and p50/p95/p99 latency in
+milliseconds per scenario, plus the git commit, for comparing runs.
+"""
+
+import argparse
+import asyncio
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from typing import Callable, List, Optional
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SCENARIOS = ("login", "refresh", "list", "get", "patch", "delete")
+PASSWORD = "benchmark-password"
+
+def percentile(sorted_values: List[float], pct: float) -> float:
+    """Nearest-rank percentile of an ascending list"""
+    if not sorted_values:
+        return 0.0
+    rank = max(1, round(pct / 100 * len(sorted_values)))
+    return sorted_values[min(rank, len(sorted_values)) - 1]
+
+def summarize(latencies: List[float], errors: int, seconds: float) -> dict:
+    latencies = sorted(latencies)
+    ms = lambda value: round(value * 1000, 3)
+    return {
+        "requests": len(latencies),
+        "errors": errors,
+        "seconds": round(seconds, 3),
+        "throughput_rps": round(len(latencies) / seconds, 1) if seconds else 0.0,
+        "latency_ms": {
+            "mean": ms(statistics.fmean(latencies)) if latencies else 0.0,
+            "p50": ms(percentile(latencies, 50)),
+            "p95": ms(percentile(latencies, 95)),
+            "p99": ms(percentile(latencies, 99)),
+            "max": ms(latencies[-1]) if latencies else 0.0,
+        },
+    }
+
+async def run_scenario(client, concurrency: int, total: int, make_request: Callable) -> dict:
+    """Send `total` requests from `concurrency` clients; make_request(worker, index) -> awaitable response"""
+    latencies: List[float] = []
+    errors = 0
+    next_index = 0
+
+    async def worker(worker_id: int):
+        nonlocal errors, next_index
+        while next_index < total:
+            index = next_index
+            next_index += 1
+            start = time.perf_counter()
+            response = await make_request(client, worker_id, index)
+            latencies.append(time.perf_counter() - start)
+            if response.status_code >= 400:
+                errors += 1
+
+    start = time.perf_counter()
+    await asyncio.gather(*(worker(i) for i in range(concurrency)))
+    return summarize(latencies, errors, time.perf_counter() - start)
+
+async def seed_users(count: int) -> List[dict]:
+    """Insert `count` users sharing one password hash; returns their id and username"""
+    from sqlalchemy import insert, select
+    from database import session_scope
+    from hashing import hash_password
+    from models import User
+
+    hashed = hash_password(PASSWORD)
+    prefix = f"bench{int(time.time())}"
+    rows = [
+        {
+            "username": f"{prefix}_{i}",
+            "email": f"{prefix}_{i}@example.com",
+            "nickname": f"Bench {i}",
+            "password": hashed,
+            "about_me": "Load test user",
+            "favorites": "coding,reading",
+        }
+        for i in range(count)
+    ]
+    async with session_scope() as db:
+        for offset in range(0, count, 500):
+            await db.execute(insert(User).values(rows[offset:offset + 500]))
+        await db.commit()
+        result = await db.execute(
+            select(User.id, User.username).where(User.username.like(f"{prefix}_%")).order_by(User.id)
+        )
+        return [{"id": row.id, "username": row.username} for row in result]
+
+async def issue_tokens(users: List[dict]) -> List[dict]:
+    """Session tokens for the given users, created the way /auth/login does but without bcrypt"""
+    from sqlalchemy import select
+    from auth import issue_session_tokens
+    from database import session_scope
+    from models import User
+
+    async with session_scope() as db:
+        result = await db.scalars(select(User).where(User.id.in_([user["id"] for user in users])))
+        by_id = {user.id: user for user in result}
+        return [await issue_session_tokens(db, by_id[user["id"]]) for user in users]
+
+async def benchmark(args) -> dict:
+    import httpx
+    import main
+
+    scenarios = [name for name in args.scenarios.split(",") if name]
+    unknown = set(scenarios) - set(SCENARIOS)
+    if unknown:
+        raise SystemExit(f"unknown scenarios: {', '.join(sorted(unknown))}")
+
+    results = {}
+    async with main.app.router.lifespan_context(main.app):
+        deletes = args.requests if "delete" in scenarios else 0
+        users = await seed_users(args.users + deletes)
+        readers, doomed = users[:args.users], users[args.users:]
+        owners = readers[:args.concurrency]
+        owner_tokens = await issue_tokens(owners)
+        owner_headers = [{"Authorization": f"Bearer {tokens['access_token']}"} for tokens in owner_tokens]
+        owner_refresh = [tokens["refresh_token"] for tokens in owner_tokens]
+        doomed_headers = [{"Authorization": f"Bearer {tokens['access_token']}"} for tokens in await issue_tokens(doomed)]
+        rng = random.Random(args.seed)
+
+        def login(client, worker, index):
+            user = rng.choice(readers)
+            return client.post("/auth/login", json={"username": user["username"], "password": PASSWORD})
+
+        async def refresh(client, worker, index):
+            response = await client.post("/auth/refresh", json={"refresh_token": owner_refresh[worker]})
+            if response.status_code == 200:
+                owner_refresh[worker] = response.json()["refresh_token"]
+            return response
+
+        def list_users(client, worker, index):
+            return client.get(
+                "/users/",
+                params={"skip": rng.randrange(max(1, args.users - 20)), "limit": 20},
+                headers=owner_headers[worker],
+            )
+
+        def get_user(client, worker, index):
+            return client.get(f"/users/{rng.choice(readers)['id']}", headers=owner_headers[worker])
+
+        def patch_user(client, worker, index):
+            return client.patch(
+                f"/users/{owners[worker]['id']}",
+                json={"nickname": f"Bench {worker}-{index}"},
+                headers=owner_headers[worker],
+            )
+
+        def delete_user(client, worker, index):
+            return client.delete(f"/users/{doomed[index]['id']}", headers=doomed_headers[index])
+
+        requests = {
+            "login": (login, args.login_requests),
+            "refresh": (refresh, args.requests),
+            "list": (list_users, args.requests),
+            "get": (get_user, args.requests),
+            "patch": (patch_user, args.requests),
+            "delete": (delete_user, deletes),
+        }
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            for name in SCENARIOS:
+                if name in scenarios:
+                    make_request, total = requests[name]
+                    results[name] = await run_scenario(client, args.concurrency, total, make_request)
+    return results
+
+def git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(
+            ["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, check=True, capture_output=True, text=True
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--users", type=int, default=500, help="users seeded for login/list/get/patch")
+    parser.add_argument("--concurrency", type=int, default=20)
+    parser.add_argument("--requests", type=int, default=500, help="requests per refresh/list/get/patch/delete scenario")
+    parser.add_argument("--login-requests", type=int, default=100, help="login requests (each costs a bcrypt verify)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS))
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--database-url", help="database to use instead of a temporary SQLite file")
+    args = parser.parse_args()
+    if args.concurrency > args.users:
+        parser.error("--concurrency cannot exceed --users (each patch client owns one user)")
+
+    with tempfile.TemporaryDirectory() as tmp:
+        # Highest-priority URL variable, so a .env file cannot point the run elsewhere
+        os.environ["MYSQL_PUBLIC_URL"] = args.database_url or f"sqlite:///{os.path.join(tmp, 'load.db')}"
+        os.environ["AUTO_MIGRATE"] = "true"
+        # Every request comes from one client; measure the endpoints, not the throttles
+        for name in ("LOGIN_IP_PER_MINUTE", "LOGIN_USER_PER_MINUTE", "HASH_QUEUE_MAX"):
+            os.environ.setdefault(name, "0")
+        sys.path.insert(0, ROOT)
+        results = asyncio.run(benchmark(args))
+
+    print(json.dumps({
+        "commit": git_commit(),
+        "config": {
+            "database": "custom" if args.database_url else "sqlite",
+            "db_async": os.getenv("DB_ASYNC", "true"),
+            "users": args.users,
+            "concurrency": args.concurrency,
+        },
+        "scenarios": results,
+    }, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+"""
+Per-row cost of serialising User rows for GET /users/
+
+Compares FastAPI's default response path (validate every row against
+List[UserResponse], then jsonable encoding and json.dumps) with the
+TypeAdapter path and the opt-in orjson fast path in serializers.py.
+
+Usage: python -m benchmarks.serialization [--rows 100] [--repeat 200]
+Prints one JSON document with microseconds per row for each path.
+"""
+
+import argparse
+import asyncio
+import json
+import time
+from datetime import date, datetime
+from typing import List
+
+from fastapi.responses import JSONResponse
+from fastapi.routing import serialize_response
+from fastapi.utils import create_response_field
+
+import serializers
+from models import User
+from schemas import UserListAdapter, UserResponse
+
+def make_users(count: int) -> List[User]:
+    return [
+        User(
+            id=i,
+            username=f"user_{i}",
+            email=f"user_{i}@example.com",
+            nickname=f"User {i}",
+            password="$2b$12$" + "x" * 53,
+            about_me="Software developer who likes long walks " * 5,
+            gender="other",
+            birthdate=date(1990, 1, 1),
+            favorites="coding,reading,gaming",
+            created_at=datetime(2024, 1, 1, 12, 0, 0),
+            updated_at=datetime(2024, 6, 1, 12, 0, 0),
+        )
+        for i in range(1, count + 1)
+    ]
+
+def bench(fn, rows: int, repeat: int) -> float:
+    """Best-of-3 microseconds per row"""
+    best = float("inf")
+    for _ in range(3):
+        start = time.perf_counter()
+        for _ in range(repeat):
+            fn()
+        elapsed = time.perf_counter() - start
+        best = min(best, elapsed)
+    return best / (repeat * rows) * 1_000_000
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--repeat", type=int, default=200)
+    args = parser.parse_args()
+
+    users = make_users(args.rows)
+    field = create_response_field(name="Response_get_users", type_=List[UserResponse])
+    loop = asyncio.new_event_loop()
+
+    def fastapi_default():
+        content = loop.run_until_complete(serialize_response(field=field, response_content=users))
+        return JSONResponse(content).body
+
+    def type_adapter():
+        return UserListAdapter.dump_json(UserListAdapter.validate_python(users))
+
+    def orjson_fast():
+        return serializers.orjson.dumps([serializers.user_dict(user) for user in users])
+
+    results = {
+        "rows": args.rows,
+        "repeat": args.repeat,
+        "us_per_row": {
+            "fastapi_default": round(bench(fastapi_default, args.rows, args.repeat), 3),
+            "type_adapter": round(bench(type_adapter, args.rows, args.repeat), 3),
+        },
+    }
+    if serializers.orjson is not None:
+        # Fast path must produce the same document as the validated path
+        assert json.loads(orjson_fast()) == json.loads(type_adapter())
+        results["us_per_row"]["orjson_fast"] = round(bench(orjson_fast, args.rows, args.repeat), 3)
+    loop.close()
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,84 @@
+#!/usr/bin/env python3
+"""
+Cold-start cost of the API
+
+Each run starts a fresh interpreter, times `import main` and the app's
+startup (lifespan), then sends the first request that needs no database
+(GET /health) and the first one that does (a failed login, which skips
+bcrypt) through the ASGI app in-process.
+
+Usage: python -m benchmarks.startup [--runs 5] [--database-url URL]
+Without --database-url a temporary, migrated SQLite database is used.
+Prints one JSON document with per-run timings and medians in milliseconds.
+"""
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+CHILD = r"""
+import asyncio, json, time
+start = time.perf_counter()
+import main
+import_ms = (time.perf_counter() - start) * 1000
+
+import httpx
+
+async def first_requests():
+    # The ASGI transport does not run the lifespan, so enter it here
+    start = time.perf_counter()
+    async with main.app.router.lifespan_context(main.app):
+        startup_ms = (time.perf_counter() - start) * 1000
+        transport = httpx.ASGITransport(app=main.app)
+        async with httpx.AsyncClient(transport=transport, base_url="http://bench") as client:
+            start = time.perf_counter()
+            await client.get("/health")
+            health_ms = (time.perf_counter() - start) * 1000
+            start = time.perf_counter()
+            await client.post("/auth/login", json={"username": "nobody", "password": "nobody"})
+            db_ms = (time.perf_counter() - start) * 1000
+    return startup_ms, health_ms, db_ms
+
+startup_ms, health_ms, db_ms = asyncio.run(first_requests())
+print(json.dumps({"import_ms": import_ms, "startup_ms": startup_ms, "first_request_ms": health_ms, "first_db_request_ms": db_ms}))
+"""
+
+def run_child(env: dict) -> dict:
+    output = subprocess.run(
+        [sys.executable, "-c", CHILD],
+        cwd=ROOT, env=env, check=True, capture_output=True, text=True
+    ).stdout
+    return json.loads(output.strip().splitlines()[-1])
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--database-url", help="database to use instead of a temporary SQLite file")
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        env = dict(os.environ)
+        env["DATABASE_URL"] = args.database_url or f"sqlite:///{os.path.join(tmp, 'startup.db')}"
+        env.pop("MYSQL_PUBLIC_URL", None)
+        env["AUTO_MIGRATE"] = "false"
+        subprocess.run([sys.executable, "manage.py", "migrate"], cwd=ROOT, env=env, check=True, capture_output=True)
+
+        runs = [run_child(env) for _ in range(args.runs)]
+
+    results = {
+        "runs": runs,
+        "median": {
+            key: round(statistics.median(run[key] for run in runs), 2)
+            for key in ("import_ms", "startup_ms", "first_request_ms", "first_db_request_ms")
+        },
+    }
+    print(json.dumps(results, indent=2))
+
+if __name__ == "__main__":
+    main()
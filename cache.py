@@ -0,0 +1,64 @@
+import threading
+import time
+from collections import OrderedDict
+from typing import Any, Callable, Hashable, Optional
+
+class TTLCache:
+    """Bounded LRU cache whose entries also expire after `ttl` seconds.
+
+    Safe to share between the event loop and threadpool workers.
+    `on_evict(key, value)` is called for entries dropped by expiry or size.
+    """
+
+    def __init__(self, maxsize: int, ttl: float, on_evict: Optional[Callable[[Hashable, Any], None]] = None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.on_evict = on_evict
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            expires, value = entry
+            if expires < time.monotonic():
+                del self._data[key]
+                self.misses += 1
+                evicted = value
+            else:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return value
+        if self.on_evict:
+            self.on_evict(key, evicted)
+        return None
+
+    def set(self, key: Hashable, value: Any):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        evicted = []
+        with self._lock:
+            self._data[key] = (time.monotonic() + self.ttl, value)
+            self._data.move_to_end(key)
+            while len(self._data) > self.maxsize:
+                evicted.append(self._data.popitem(last=False))
+        if self.on_evict:
+            for old_key, (_, old_value) in evicted:
+                self.on_evict(old_key, old_value)
+
+    def pop(self, key: Hashable) -> Optional[Any]:
+        with self._lock:
+            entry = self._data.pop(key, None)
+        return entry[1] if entry else None
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+
+    def __len__(self) -> int:
+        return len(self._data)
@@ -1,13 +1,41 @@
-from sqlalchemy.orm import Session
+import asyncio
+import base64
+import os
+import re
+from sqlalchemy import delete, insert, or_, select, update
+from sqlalchemy.dialects.mysql import match
+from sqlalchemy.ext.asyncio import AsyncSession
 from sqlalchemy.exc import IntegrityError
-from models import User
-from schemas import UserCreate, UserUpdate, UserPatch
-from typing import List, Optional
-from auth import get_password_hash
+from models import User, Token, RefreshToken, UserFavorite
+from schemas import UserCreate, UserUpdate, UserPatch, normalize_favorite, split_favorites
+from typing import AsyncIterator, Dict, List, Optional, Sequence, Tuple
+from auth import get_password_hash, invalidate_user
+import search
 
-def create_user(db: Session, user: UserCreate) -> User:
+# Bulk creation limits
+BULK_CREATE_MAX = int(os.getenv("BULK_CREATE_MAX", "1000"))
+BULK_CREATE_CHUNK_SIZE = int(os.getenv("BULK_CREATE_CHUNK_SIZE", "200"))
+# Largest page served by GET /users/
+LIST_USERS_MAX = int(os.getenv("LIST_USERS_MAX", "1000"))
+# Maximum ids resolved by one batch fetch
+BATCH_FETCH_MAX = int(os.getenv("BATCH_FETCH_MAX", "500"))
+# Rows fetched per round trip from the server-side cursor during exports
+EXPORT_BATCH_SIZE = int(os.getenv("EXPORT_BATCH_SIZE", "1000"))
+
+def _favorite_rows(user_id: int, favorites: Optional[str]) -> List[Dict]:
+    return [{"user_id": user_id, "favorite": favorite} for favorite in split_favorites(favorites)]
+
+async def _replace_favorites(db: AsyncSession, user_id: int, favorites: Optional[str]):
+    """Rewrite a user's user_favorites rows; the caller commits"""
+    await db.execute(delete(UserFavorite).where(UserFavorite.user_id == user_id))
+    rows = _favorite_rows(user_id, favorites)
+    if rows:
+        await db.execute(insert(UserFavorite).values(rows))
+
+async def create_user(db: AsyncSession, user: UserCreate) -> User:
     """Create a new user"""
-    hashed_password = get_password_hash(user.password)
+    # Public signup, so it is subject to the hashing admission cap
+    hashed_password = await get_password_hash(user.password, admission=True)
     db_user = User(
         username=user.username,
         email=user.email,
@@ -20,95 +48,347 @@ def create_user(db: Session, user: UserCreate) -> User:
     )
     try:
         db.add(db_user)
-        db.commit()
-        db.refresh(db_user)
+        if split_favorites(user.favorites):
+            # Assigns db_user.id for the favorites rows, in the same transaction
+            await db.flush()
+            await db.execute(insert(UserFavorite).values(_favorite_rows(db_user.id, user.favorites)))
+        await db.commit()
+        await db.refresh(db_user)
+        search.user_changed(db_user)
         return db_user
     except IntegrityError:
-        db.rollback()
+        await db.rollback()
         raise ValueError("Username or email already exists")
 
-def get_user(db: Session, user_id: int) -> Optional[User]:
-    """Get user by ID"""
-    return db.query(User).filter(User.id == user_id).first()
+async def create_users_bulk(db: AsyncSession, users: List[UserCreate]) -> List[Dict]:
+    """Create many users with multi-row INSERTs, one transaction per chunk.
+
+    Returns one result per input item, in order: {"index", "status", "id", "detail"}
+    where status is "created" or "conflict". A conflicting item never fails the batch.
+    """
+    results = [{"index": index, "status": "created", "id": None, "detail": None} for index in range(len(users))]
+    seen_usernames = set()
+    seen_emails = set()
+    for start in range(0, len(users), BULK_CREATE_CHUNK_SIZE):
+        chunk = list(range(start, min(start + BULK_CREATE_CHUNK_SIZE, len(users))))
+
+        # Conflicts with existing rows: one query per chunk
+        existing = await db.execute(
+            select(User.username, User.email).where(or_(
+                User.username.in_([users[i].username for i in chunk]),
+                User.email.in_([users[i].email for i in chunk])
+            ))
+        )
+        taken_usernames = set(seen_usernames)
+        taken_emails = set(seen_emails)
+        for username, email in existing:
+            taken_usernames.add(username)
+            taken_emails.add(email)
+
+        pending = []
+        for i in chunk:
+            item = users[i]
+            if item.username in taken_usernames or item.email in taken_emails:
+                results[i].update(status="conflict", detail="Username or email already exists")
+                continue
+            taken_usernames.add(item.username)
+            taken_emails.add(item.email)
+            pending.append(i)
+        seen_usernames.update(users[i].username for i in pending)
+        seen_emails.update(users[i].email for i in pending)
+        if not pending:
+            continue
+
+        # Only hash passwords that will actually be inserted
+        hashes = await asyncio.gather(*(get_password_hash(users[i].password, bulk=True) for i in pending))
+        rows = {}
+        for i, hashed_password in zip(pending, hashes):
+            rows[i] = users[i].dict(exclude={"password"})
+            rows[i]["password"] = hashed_password
+
+        try:
+            await db.execute(insert(User).values(list(rows.values())))
+            await db.commit()
+        except IntegrityError:
+            # Lost a race with a concurrent insert: retry row by row
+            await db.rollback()
+            for i in list(pending):
+                try:
+                    await db.execute(insert(User).values(rows[i]))
+                    await db.commit()
+                except IntegrityError:
+                    await db.rollback()
+                    results[i].update(status="conflict", detail="Username or email already exists")
+                    pending.remove(i)
+
+        created = await db.execute(
+            select(User.id, User.username).where(User.username.in_([users[i].username for i in pending]))
+        )
+        ids = {username: user_id for user_id, username in created}
+        favorite_rows = []
+        for i in pending:
+            results[i]["id"] = ids.get(users[i].username)
+            if results[i]["id"] is not None:
+                search.user_changed(User(id=results[i]["id"], **rows[i]))
+                favorite_rows.extend(_favorite_rows(results[i]["id"], users[i].favorites))
+        if favorite_rows:
+            await db.execute(insert(UserFavorite).values(favorite_rows))
+            await db.commit()
+    return results
+
+def _select_users(fields: Optional[Sequence[str]] = None):
+    """SELECT whole User rows, or only the given columns"""
+    if fields:
+        return select(*(getattr(User, field) for field in fields))
+    return select(User)
+
+async def _fetch_users(db: AsyncSession, statement, fields: Optional[Sequence[str]] = None) -> list:
+    """Run a user query; column-only queries return row mappings"""
+    if fields:
+        result = await db.execute(statement)
+        return result.mappings().all()
+    result = await db.scalars(statement)
+    return result.all()
+
+async def get_user(db: AsyncSession, user_id: int, fields: Optional[Sequence[str]] = None) -> Optional[User]:
+    """Get user by ID, optionally loading only the given columns"""
+    users = await _fetch_users(db, _select_users(fields).where(User.id == user_id), fields)
+    return users[0] if users else None
 
-def get_user_by_username(db: Session, username: str) -> Optional[User]:
+async def get_user_version(db: AsyncSession, user_id: int):
+    """Get only (id, version, created_at, updated_at) of a user, for conditional requests"""
+    result = await db.execute(
+        select(User.id, User.version, User.created_at, User.updated_at).where(User.id == user_id)
+    )
+    return result.first()
+
+async def get_users_by_ids(db: AsyncSession, user_ids: List[int], fields: Optional[Sequence[str]] = None) -> list:
+    """Get users for a list of ids with one IN query.
+
+    Returns one entry per requested id, in request order, with None for missing ids.
+    `fields` must include "id" when given.
+    """
+    if not user_ids:
+        return []
+    users = await _fetch_users(db, _select_users(fields).where(User.id.in_(set(user_ids))), fields)
+    by_id = {(user["id"] if fields else user.id): user for user in users}
+    return [by_id.get(user_id) for user_id in user_ids]
+
+async def get_user_by_username(db: AsyncSession, username: str) -> Optional[User]:
     """Get user by username"""
-    return db.query(User).filter(User.username == username).first()
+    return await db.scalar(select(User).where(User.username == username))
 
-def get_user_by_email(db: Session, email: str) -> Optional[User]:
+async def get_user_by_email(db: AsyncSession, email: str) -> Optional[User]:
     """Get user by email"""
-    return db.query(User).filter(User.email == email).first()
+    return await db.scalar(select(User).where(User.email == email))
 
-def get_users(db: Session, skip: int = 0, limit: int = 100) -> List[User]:
-    """Get all users with pagination"""
-    return db.query(User).offset(skip).limit(limit).all()
+def _filter_favorite(statement, favorite: Optional[str]):
+    """Restrict a user query to users with the given favorite (user_favorites index lookup)"""
+    if favorite is None:
+        return statement
+    return (
+        statement
+        .join(UserFavorite, UserFavorite.user_id == User.id)
+        .where(UserFavorite.favorite == normalize_favorite(favorite))
+    )
 
-def update_user(db: Session, user_id: int, user: UserUpdate) -> Optional[User]:
-    """Update user with PUT method (full update)"""
-    db_user = get_user(db, user_id)
-    if not db_user:
-        return None
-    
-    update_data = user.dict(exclude_unset=True)
-    
-    # Check for unique constraints
-    if 'username' in update_data:
-        existing_user = get_user_by_username(db, update_data['username'])
-        if existing_user and existing_user.id != user_id:
-            raise ValueError("Username already exists")
-    
-    if 'email' in update_data:
-        existing_user = get_user_by_email(db, update_data['email'])
-        if existing_user and existing_user.id != user_id:
-            raise ValueError("Email already exists")
-    
-    for field, value in update_data.items():
-        setattr(db_user, field, value)
-    
+async def get_users(
+    db: AsyncSession,
+    skip: int = 0,
+    limit: int = 100,
+    fields: Optional[Sequence[str]] = None,
+    favorite: Optional[str] = None
+) -> List[User]:
+    """Get all users with pagination, optionally loading only the given columns"""
+    statement = _filter_favorite(_select_users(fields), favorite).offset(skip).limit(limit)
+    return await _fetch_users(db, statement, fields)
+
+async def stream_users(
+    db: AsyncSession,
+    fields: Sequence[str],
+    batch_size: int = EXPORT_BATCH_SIZE
+) -> AsyncIterator[list]:
+    """Stream the given user columns in id order, `batch_size` row mappings at a time.
+
+    Uses a server-side cursor, so memory stays flat however large the table is.
+    """
+    statement = _select_users(fields).order_by(User.id).execution_options(yield_per=batch_size)
+    result = await db.stream(statement)
+    async for partition in result.mappings().partitions():
+        yield partition
+
+def encode_cursor(user_id: int) -> str:
+    """Opaque pagination cursor pointing after the given user id"""
+    return base64.urlsafe_b64encode(str(user_id).encode()).decode().rstrip("=")
+
+def decode_cursor(cursor: str) -> int:
+    """Decode a cursor from encode_cursor; an empty cursor starts from the beginning"""
+    if not cursor:
+        return 0
     try:
-        db.commit()
-        db.refresh(db_user)
-        return db_user
-    except IntegrityError:
-        db.rollback()
-        raise ValueError("Update failed due to constraint violation")
+        padded = cursor + "=" * (-len(cursor) % 4)
+        return int(base64.urlsafe_b64decode(padded.encode()).decode())
+    except (ValueError, UnicodeDecodeError):
+        raise ValueError("Invalid cursor")
 
-def patch_user(db: Session, user_id: int, user: UserPatch) -> Optional[User]:
-    """Update user with PATCH method (partial update)"""
-    db_user = get_user(db, user_id)
-    if not db_user:
-        return None
-    
-    update_data = user.dict(exclude_unset=True)
-    
-    # Check for unique constraints
-    if 'username' in update_data:
-        existing_user = get_user_by_username(db, update_data['username'])
-        if existing_user and existing_user.id != user_id:
-            raise ValueError("Username already exists")
-    
-    if 'email' in update_data:
-        existing_user = get_user_by_email(db, update_data['email'])
-        if existing_user and existing_user.id != user_id:
-            raise ValueError("Email already exists")
-    
-    for field, value in update_data.items():
-        setattr(db_user, field, value)
-    
+async def get_users_page(
+    db: AsyncSession,
+    after_id: int = 0,
+    limit: int = 100,
+    fields: Optional[Sequence[str]] = None,
+    favorite: Optional[str] = None
+) -> Tuple[List[User], Optional[int]]:
+    """Get users with keyset pagination on the primary key.
+
+    Returns the page and the id to continue after, or None on the last page.
+    `fields` must include "id" when given.
+    """
+    if limit < 1:
+        return [], None
+    statement = (
+        _filter_favorite(_select_users(fields), favorite)
+        .where(User.id > after_id)
+        .order_by(User.id)
+        .limit(limit + 1)
+    )
+    users = await _fetch_users(db, statement, fields)
+    if len(users) > limit:
+        users = users[:limit]
+        last = users[-1]
+        return users, last["id"] if fields else last.id
+    return users, None
+
+async def search_users(
+    db: AsyncSession,
+    query: str,
+    skip: int = 0,
+    limit: int = 20
+) -> Tuple[List[User], Optional[int]]:
+    """Users matching `query` in username, nickname or about_me, best match first.
+
+    MySQL answers from the FULLTEXT index (natural language mode); other
+    databases rank with the in-process search.index and load the page by id.
+    Returns the page and the `skip` of the next page, or None on the last page.
+    """
+    if search.use_fulltext():
+        relevance = match(User.username, User.nickname, User.about_me, against=query)
+        statement = select(User).where(relevance).order_by(relevance.desc(), User.id).offset(skip).limit(limit + 1)
+        users = list((await db.scalars(statement)).all())
+    else:
+        await search.ensure_indexes()
+        user_ids = search.index.search(query, skip, limit + 1)
+        users = [user for user in await get_users_by_ids(db, user_ids) if user is not None]
+    if len(users) > limit:
+        return users[:limit], skip + limit
+    return users, None
+
+class ConflictError(ValueError):
+    """A write collided with a unique index; `field` names the column"""
+
+    def __init__(self, field: Optional[str]):
+        self.field = field
+        if field:
+            super().__init__(f"{field.capitalize()} already exists")
+        else:
+            super().__init__("Update failed due to constraint violation")
+
+# Unique index (MySQL key name) or column (SQLite) -> field reported to the client
+_UNIQUE_FIELDS = {
+    "ix_users_username": "username",
+    "ix_users_email": "email",
+    "username": "username",
+    "email": "email",
+}
+# MySQL: Duplicate entry '...' for key '[users.]ix_users_email'
+_MYSQL_DUPLICATE_KEY = re.compile(r"for key '(?:\w+\.)?(\w+)'$")
+# SQLite: UNIQUE constraint failed: users.email
+_SQLITE_UNIQUE_COLUMN = re.compile(r"^UNIQUE constraint failed: users\.(\w+)$")
+MYSQL_DUPLICATE_ENTRY = 1062
+
+def _conflict_field(error: IntegrityError) -> Optional[str]:
+    """Field whose unique index an IntegrityError violated, or None for other
+    violations (NOT NULL, foreign keys, ...)"""
+    orig = error.orig
+    message = str(orig)
+    if getattr(orig, "args", None) and orig.args[0] == MYSQL_DUPLICATE_ENTRY:
+        found = _MYSQL_DUPLICATE_KEY.search(str(orig.args[1]) if len(orig.args) > 1 else message)
+    else:
+        found = _SQLITE_UNIQUE_COLUMN.match(message)
+    return _UNIQUE_FIELDS.get(found.group(1)) if found else None
+
+async def _write_user(
+    db: AsyncSession, user_id: int, update_data: Dict, versions: Optional[List[int]] = None
+) -> Optional[User]:
+    """Apply an update with a single UPDATE statement.
+
+    Uniqueness is left to the unique indexes. With `versions`, the row is only
+    updated while its version is one of them (If-Match). The new row state
+    comes from UPDATE ... RETURNING where the dialect has it; otherwise (MySQL)
+    the row is read back through `db`, which must be a primary session.
+    Returns None when no row was updated.
+    """
+    values = dict(update_data, version=User.version + 1)
+    statement = (
+        update(User)
+        .where(User.id == user_id)
+        .values(**values)
+        .execution_options(synchronize_session=False)
+    )
+    if versions is not None:
+        statement = statement.where(User.version.in_(versions))
+    returning = db.get_bind().dialect.update_returning
+    if returning:
+        statement = statement.returning(*User.__table__.columns)
     try:
-        db.commit()
-        db.refresh(db_user)
-        return db_user
-    except IntegrityError:
-        db.rollback()
-        raise ValueError("Update failed due to constraint violation")
+        result = await db.execute(statement)
+        row = result.first() if returning else None
+        found = row is not None if returning else result.rowcount > 0
+        if found and "favorites" in update_data:
+            await _replace_favorites(db, user_id, update_data["favorites"])
+        await db.commit()
+    except IntegrityError as e:
+        await db.rollback()
+        raise ConflictError(_conflict_field(e))
+    if returning:
+        if row is None:
+            return None
+        user = User(**row._mapping)
+    elif result.rowcount == 0:
+        return None
+    else:
+        # populate_existing: the session may hold this user from authentication
+        user = await db.scalar(
+            select(User).where(User.id == user_id).execution_options(populate_existing=True)
+        )
+    invalidate_user(user_id)
+    if user is not None:
+        search.user_changed(user)
+    return user
+
+async def update_user(
+    db: AsyncSession, user_id: int, user: UserUpdate, versions: Optional[List[int]] = None
+) -> Optional[User]:
+    """Update user with PUT method (full update)"""
+    return await _write_user(db, user_id, user.dict(exclude_unset=True), versions)
 
-def delete_user(db: Session, user_id: int) -> bool:
+async def patch_user(
+    db: AsyncSession, user_id: int, user: UserPatch, versions: Optional[List[int]] = None
+) -> Optional[User]:
+    """Update user with PATCH method (partial update)"""
+    return await _write_user(db, user_id, user.dict(exclude_unset=True), versions)
+
+async def delete_user(db: AsyncSession, user_id: int) -> bool:
     """Delete user by ID"""
-    db_user = get_user(db, user_id)
+    db_user = await get_user(db, user_id)
     if not db_user:
         return False
-    
-    db.delete(db_user)
-    db.commit()
-    return True 
\ No newline at end of file
+
+    # Tokens and favorites cascade in MySQL; delete explicitly for SQLite without FK enforcement
+    await db.execute(delete(Token).where(Token.user_id == user_id))
+    await db.execute(delete(RefreshToken).where(RefreshToken.user_id == user_id))
+    await db.execute(delete(UserFavorite).where(UserFavorite.user_id == user_id))
+    await db.delete(db_user)
+    await db.commit()
+    invalidate_user(user_id)
+    search.user_deleted(user_id)
+    return True
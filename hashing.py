@@ -0,0 +1,181 @@
+import asyncio
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from typing import Optional, Tuple
+from passlib.context import CryptContext
+from passlib.registry import get_crypt_handler
+
+# Hashing pool configuration
+# HASH_POOL selects "thread" (bcrypt releases the GIL) or "process" workers
+HASH_POOL = os.getenv("HASH_POOL", "thread").lower()
+HASH_WORKERS = int(os.getenv("HASH_WORKERS", str(os.cpu_count() or 1)))
+# Maximum hash operations handed to the pool at once; the rest wait in line
+HASH_CONCURRENCY = int(os.getenv("HASH_CONCURRENCY", str(HASH_WORKERS)))
+# Admission cap: once this many hash operations wait in line, login and signup
+# are turned away with 429 instead of queueing more work (0 = never)
+HASH_QUEUE_MAX = int(os.getenv("HASH_QUEUE_MAX", str(HASH_CONCURRENCY * 8)))
+# Retry-After sent with those 429 responses
+HASH_RETRY_AFTER_SECONDS = int(os.getenv("HASH_RETRY_AFTER_SECONDS", "1"))
+# Hash operations of POST /users/bulk allowed at once. They run on this many
+# extra workers under their own semaphore, so logins and signups never queue
+# behind a batch
+HASH_BULK_CONCURRENCY = int(os.getenv("HASH_BULK_CONCURRENCY", "1"))
+
+# Password hashing: new hashes use the first scheme; hashes made with a later
+# scheme or different cost settings still verify, and are rehashed on login
+PASSWORD_SCHEMES = [scheme.strip() for scheme in os.getenv("PASSWORD_SCHEMES", "bcrypt").split(",") if scheme.strip()]
+# Cost settings; measure them on the production host with `python manage.py calibrate-hash`
+BCRYPT_ROUNDS = int(os.getenv("BCRYPT_ROUNDS", "12"))
+ARGON2_TIME_COST = int(os.getenv("ARGON2_TIME_COST", "2"))
+ARGON2_MEMORY_COST = int(os.getenv("ARGON2_MEMORY_COST", "102400"))  # KiB
+ARGON2_PARALLELISM = int(os.getenv("ARGON2_PARALLELISM", "8"))
+
+def _available_schemes() -> list:
+    """PASSWORD_SCHEMES without schemes whose backend is not installed"""
+    schemes = []
+    for scheme in PASSWORD_SCHEMES:
+        if get_crypt_handler(scheme).has_backend():
+            schemes.append(scheme)
+        else:
+            print(f"WARNING: password scheme {scheme} is unavailable (argon2 needs argon2-cffi); ignoring it")
+    return schemes or ["bcrypt"]
+
+def cost_settings(scheme: str, **overrides) -> dict:
+    """CryptContext keyword settings of one scheme: the configured costs plus overrides"""
+    if scheme == "bcrypt":
+        settings = {"rounds": BCRYPT_ROUNDS}
+    elif scheme == "argon2":
+        settings = {
+            "time_cost": ARGON2_TIME_COST,
+            "memory_cost": ARGON2_MEMORY_COST,
+            "parallelism": ARGON2_PARALLELISM,
+        }
+    else:
+        settings = {}
+    settings.update(overrides)
+    return {f"{scheme}__{name}": value for name, value in settings.items()}
+
+def make_context(schemes: list, **overrides) -> CryptContext:
+    """CryptContext hashing with schemes[0]; overrides apply to that scheme"""
+    settings = {}
+    for scheme in schemes:
+        settings.update(cost_settings(scheme, **(overrides if scheme == schemes[0] else {})))
+    return CryptContext(schemes=schemes, deprecated="auto", **settings)
+
+pwd_context = make_context(_available_schemes())
+
+_executor = None
+_semaphore = None
+_bulk_semaphore = None
+
+# Queue-depth counters, updated only from the event loop
+_stats = {
+    "waiting": 0,
+    "running": 0,
+    "completed": 0,
+    "max_waiting": 0,
+    # Waiting operations that asked for admission (login, signup); bulk
+    # hashing queues on its own semaphore and does not count towards HASH_QUEUE_MAX
+    "admission_waiting": 0,
+    "rejected": 0,
+}
+
+class PoolBusy(Exception):
+    """Raised instead of queueing when HASH_QUEUE_MAX admission-controlled operations already wait"""
+
+    def __init__(self, retry_after: float = HASH_RETRY_AFTER_SECONDS):
+        super().__init__("Server is busy, try again shortly")
+        self.retry_after = retry_after
+
+def hash_password(password: str) -> str:
+    """Hash a password (blocking, runs inside a pool worker)"""
+    return pwd_context.hash(password)
+
+def check_password(plain_password: str, hashed_password: str) -> bool:
+    """Verify a password against its hash (blocking, runs inside a pool worker)"""
+    return pwd_context.verify(plain_password, hashed_password)
+
+def check_and_update_password(plain_password: str, hashed_password: str) -> Tuple[bool, Optional[str]]:
+    """Verify a password; when its hash uses an old scheme or cost, also return
+    a new hash made with the current settings (blocking, runs inside a pool worker)"""
+    return pwd_context.verify_and_update(plain_password, hashed_password)
+
+def measure_hash(scheme: str, samples: int = 3, **overrides) -> float:
+    """Median seconds to hash a password with one scheme and cost (blocking)"""
+    context = make_context([scheme], **overrides)
+    timings = []
+    for _ in range(samples):
+        start = time.perf_counter()
+        context.hash("calibration-password")
+        timings.append(time.perf_counter() - start)
+    return sorted(timings)[len(timings) // 2]
+
+def get_executor():
+    """Create the worker pool on first use"""
+    global _executor
+    if _executor is None:
+        if HASH_POOL == "process":
+            _executor = ProcessPoolExecutor(max_workers=HASH_WORKERS + HASH_BULK_CONCURRENCY)
+        else:
+            _executor = ThreadPoolExecutor(max_workers=HASH_WORKERS + HASH_BULK_CONCURRENCY, thread_name_prefix="hashing")
+    return _executor
+
+def _get_semaphore(bulk: bool = False) -> asyncio.Semaphore:
+    global _semaphore, _bulk_semaphore
+    if bulk:
+        if _bulk_semaphore is None:
+            _bulk_semaphore = asyncio.Semaphore(HASH_BULK_CONCURRENCY)
+        return _bulk_semaphore
+    if _semaphore is None:
+        _semaphore = asyncio.Semaphore(HASH_CONCURRENCY)
+    return _semaphore
+
+async def run_in_pool(fn, *args, admission: bool = False, bulk: bool = False):
+    """Run a hashing function in the pool, bounded by HASH_CONCURRENCY
+    (HASH_BULK_CONCURRENCY with bulk=True).
+
+    With admission=True, raise PoolBusy rather than queue behind HASH_QUEUE_MAX
+    other admission-controlled waiters.
+    """
+    if admission:
+        if HASH_QUEUE_MAX and _stats["admission_waiting"] >= HASH_QUEUE_MAX:
+            _stats["rejected"] += 1
+            raise PoolBusy()
+        _stats["admission_waiting"] += 1
+    semaphore = _get_semaphore(bulk)
+    _stats["waiting"] += 1
+    _stats["max_waiting"] = max(_stats["max_waiting"], _stats["waiting"])
+    try:
+        await semaphore.acquire()
+    finally:
+        _stats["waiting"] -= 1
+        if admission:
+            _stats["admission_waiting"] -= 1
+    _stats["running"] += 1
+    try:
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(get_executor(), fn, *args)
+    finally:
+        _stats["running"] -= 1
+        _stats["completed"] += 1
+        semaphore.release()
+
+def stats() -> dict:
+    """Current hashing pool queue depth and totals"""
+    return {
+        "pool": HASH_POOL,
+        "workers": HASH_WORKERS,
+        "concurrency": HASH_CONCURRENCY,
+        "bulk_concurrency": HASH_BULK_CONCURRENCY,
+        "queue_max": HASH_QUEUE_MAX,
+        "scheme": pwd_context.default_scheme(),
+        **_stats,
+    }
+
+def shutdown():
+    """Stop the worker pool (called on application shutdown)"""
+    global _executor
+    if _executor is not None:
+        _executor.shutdown(wait=False, cancel_futures=True)
+        _executor = None
@@ -0,0 +1,84 @@
+import hashlib
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import Dict, List, Optional, Sequence
+from fastapi import Request, Response, status
+
+def _utc(value: datetime) -> datetime:
+    """Treat naive database timestamps as UTC"""
+    if value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)
+    return value.astimezone(timezone.utc)
+
+def user_etag(user_id: int, version: int, fields: Optional[Sequence[str]] = None) -> str:
+    """Strong ETag for a user representation, derived from id + users.version"""
+    tag = f"u{user_id}-v{version}"
+    if fields:
+        # Partial representations get their own validator
+        tag += "-" + hashlib.sha1(",".join(fields).encode()).hexdigest()[:8]
+    return f'"{tag}"'
+
+def body_etag(body: bytes) -> str:
+    """Strong ETag from a hash of a serialised response body"""
+    return f'"{hashlib.blake2b(body, digest_size=16).hexdigest()}"'
+
+def last_modified(created_at: Optional[datetime], updated_at: Optional[datetime]) -> Optional[str]:
+    """HTTP date for the Last-Modified header"""
+    modified = updated_at or created_at
+    if modified is None:
+        return None
+    return format_datetime(_utc(modified).replace(microsecond=0), usegmt=True)
+
+def _parse_etags(header: str) -> List[str]:
+    return [tag.strip() for tag in header.split(",") if tag.strip()]
+
+def is_not_modified(request: Request, etag: str, modified: Optional[str] = None) -> bool:
+    """Evaluate If-None-Match (preferred) or If-Modified-Since for a GET"""
+    if_none_match = request.headers.get("if-none-match")
+    if if_none_match is not None:
+        # Weak comparison, as RFC 9110 requires for If-None-Match
+        tags = [tag[2:] if tag.startswith("W/") else tag for tag in _parse_etags(if_none_match)]
+        return "*" in tags or etag in tags
+    if_modified_since = request.headers.get("if-modified-since")
+    if if_modified_since and modified:
+        try:
+            return parsedate_to_datetime(modified) <= parsedate_to_datetime(if_modified_since)
+        except (TypeError, ValueError):
+            return False
+    return False
+
+def if_match_versions(request: Request, user_id: int) -> Optional[List[int]]:
+    """Versions of a user that satisfy its If-Match header.
+
+    None when there is no header or it is "*" (any version). Otherwise the
+    versions named by the header's full-representation ETags for this user,
+    possibly none. Strong comparison: weak validators never match.
+    """
+    if_match = request.headers.get("if-match")
+    if if_match is None:
+        return None
+    tags = _parse_etags(if_match)
+    if "*" in tags:
+        return None
+    prefix = f'"u{user_id}-v'
+    return [
+        int(tag[len(prefix):-1])
+        for tag in tags
+        if tag.startswith(prefix) and tag.endswith('"') and tag[len(prefix):-1].isdigit()
+    ]
+
+def cache_headers(etag: str, modified: Optional[str] = None) -> Dict[str, str]:
+    headers = {"ETag": etag}
+    if modified:
+        headers["Last-Modified"] = modified
+    return headers
+
+def not_modified(etag: str, modified: Optional[str] = None) -> Response:
+    return Response(status_code=status.HTTP_304_NOT_MODIFIED, headers=cache_headers(etag, modified))
+
+def etag_response(request: Request, body: bytes, media_type: str = "application/json") -> Response:
+    """Send a serialised body with a content-hash ETag, or 304 if the client has it"""
+    etag = body_etag(body)
+    if is_not_modified(request, etag):
+        return not_modified(etag)
+    return Response(content=body, media_type=media_type, headers=cache_headers(etag))
@@ -1,39 +1,66 @@
-from fastapi import FastAPI, Depends, HTTPException, status
+from fastapi import FastAPI, Depends, HTTPException, Query, Request, Response, status
+from fastapi.encoders import jsonable_encoder
 from fastapi.middleware.cors import CORSMiddleware
+from fastapi.responses import JSONResponse, ORJSONResponse, PlainTextResponse, StreamingResponse
 from fastapi.security import HTTPAuthorizationCredentials
-from sqlalchemy.orm import Session
-from typing import List
+from sqlalchemy.ext.asyncio import AsyncSession
+from contextlib import asynccontextmanager
+from typing import List, Optional, Union
+import asyncio
+import csv
+import io
+import math
 import os
 from dotenv import load_dotenv
-from datetime import timedelta
 
 # Load environment variables from .env file
 load_dotenv()
 
-# Debug: Check if environment variable is loaded
-mysql_public_url = os.getenv("MYSQL_PUBLIC_URL")
-database_url = os.getenv("DATABASE_URL")
-mysql_url = os.getenv("MYSQL_URL")
-print(f"DEBUG: MYSQL_PUBLIC_URL = {mysql_public_url}")
-print(f"DEBUG: DATABASE_URL = {database_url}")
-print(f"DEBUG: MYSQL_URL = {mysql_url}")
-if not mysql_public_url and not database_url and not mysql_url:
+if not (os.getenv("MYSQL_PUBLIC_URL") or os.getenv("DATABASE_URL") or os.getenv("MYSQL_URL")):
     print("WARNING: No database environment variables found!")
     print("Make sure you have created a .env file with MYSQL_PUBLIC_URL=your_connection_string")
 
-from database import get_db, engine
-from models import Base, User
-from schemas import UserCreate, UserUpdate, UserPatch, UserResponse, UserLogin, Token
+# Run `python manage.py migrate` as a release step; AUTO_MIGRATE=true migrates on startup instead
+AUTO_MIGRATE = os.getenv("AUTO_MIGRATE", "false").lower() in ("1", "true", "yes", "on")
+
+import database
+from database import get_db, session_scope
+from migrations import migrate
+from models import User
+from schemas import (
+    UserCreate, UserUpdate, UserPatch, UserResponse, UserPage, UserSearchPage, UserSuggestion, UserBatchRequest, UserBatchResponse,
+    BulkUserResponse, UserLogin, Token, RefreshRequest, parse_user_fields, user_fields_model
+)
 import crud
-from auth import authenticate_user, create_access_token, get_current_user, store_token, delete_token, ACCESS_TOKEN_EXPIRE_MINUTES, security
+import hashing
+import http_cache
+import metrics
+import ratelimit
+import search
+import serializers
+import timing
+from auth import authenticate_user, get_current_user, get_read_db, require_bulk_api_key, delete_token, revoke_all_tokens, issue_session_tokens, rotate_refresh_token, purge_expired_tokens_forever, TOKEN_MODE, security
 
-# Create database tables
-Base.metadata.create_all(bind=engine)
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    if AUTO_MIGRATE:
+        await migrate()
+    await database.prewarm()
+    background = [asyncio.create_task(purge_expired_tokens_forever())]
+    if search.SEARCH_INDEX_REFRESH_SECONDS > 0:
+        background.append(asyncio.create_task(search.refresh_indexes_forever()))
+    yield
+    for task in background:
+        task.cancel()
+    hashing.shutdown()
+    await database.dispose()
 
 app = FastAPI(
     title="User Management API",
     description="A simple REST API for user management with MySQL and JWT authentication",
-    version="1.0.0"
+    version="1.0.0",
+    lifespan=lifespan,
+    default_response_class=ORJSONResponse if serializers.FAST_JSON else JSONResponse
 )
 
 # Add CORS middleware
@@ -45,6 +72,23 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+# SQL query count/time and auth time per request, sent as a Server-Timing header
+timing.install()
+app.add_middleware(timing.ServerTimingMiddleware)
+
+# Per-route request counts and latency for GET /metrics (outermost, so it times everything)
+app.add_middleware(metrics.MetricsMiddleware)
+
+@app.exception_handler(ratelimit.RateLimited)
+@app.exception_handler(hashing.PoolBusy)
+async def too_many_requests(request: Request, exc: Union[ratelimit.RateLimited, hashing.PoolBusy]):
+    """429 with Retry-After for login throttling and the hashing admission cap"""
+    return JSONResponse(
+        status_code=status.HTTP_429_TOO_MANY_REQUESTS,
+        content={"detail": str(exc)},
+        headers={"Retry-After": str(max(1, math.ceil(exc.retry_after)))}
+    )
+
 @app.get("/")
 async def root():
     """Root endpoint"""
@@ -53,13 +97,61 @@ async def root():
 @app.get("/health")
 async def health_check():
     """Health check endpoint"""
-    return {"status": "healthy"}
+    return {"status": "healthy", "hashing": hashing.stats()}
+
+@app.get("/health/pool")
+async def pool_health():
+    """Connection pool sizing, usage and checkout wait times"""
+    return database.pool_diagnostics()
+
+@app.get("/metrics", response_class=PlainTextResponse, include_in_schema=False)
+async def prometheus_metrics():
+    """Prometheus scrape endpoint"""
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+def _parse_fields(fields: Optional[str]):
+    """Validate a `fields=` query parameter"""
+    if fields is None:
+        return None
+    try:
+        return parse_user_fields(fields)
+    except ValueError as e:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=str(e)
+        )
+
+def _partial_users(rows, fields):
+    """Serialise column-only rows through the reduced response model"""
+    model = user_fields_model(fields)
+    return [jsonable_encoder(model(**row)) for row in rows]
+
+def _user_not_updated(request: Request) -> HTTPException:
+    """Error for an update that changed no row: a failed If-Match, or a missing user"""
+    if request.headers.get("if-match") is not None:
+        return HTTPException(
+            status_code=status.HTTP_412_PRECONDITION_FAILED,
+            detail="User was modified; fetch it again before updating"
+        )
+    return HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="User not found"
+    )
+
+def _set_user_cache_headers(response: Response, user: User):
+    etag = http_cache.user_etag(user.id, user.version)
+    response.headers.update(http_cache.cache_headers(etag, http_cache.last_modified(user.created_at, user.updated_at)))
 
 # Authentication endpoints
 @app.post("/auth/login", response_model=Token)
-async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
+async def login(request: Request, user_credentials: UserLogin, db: AsyncSession = Depends(get_db)):
     """Login to get access token"""
-    user = authenticate_user(db, user_credentials.username, user_credentials.password)
+    await ratelimit.check_login(ratelimit.client_ip(request), user_credentials.username)
+    try:
+        user = await authenticate_user(db, user_credentials.username, user_credentials.password)
+    except hashing.PoolBusy:
+        await ratelimit.refund_login(user_credentials.username)
+        raise
     if not user:
         raise HTTPException(
             status_code=status.HTTP_401_UNAUTHORIZED,
@@ -67,79 +159,296 @@ async def login(user_credentials: UserLogin, db: Session = Depends(get_db)):
             headers={"WWW-Authenticate": "Bearer"},
         )
     
-    access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
-    access_token = create_access_token(
-        data={"sub": user.username, "user_id": user.id}, 
-        expires_delta=access_token_expires
-    )
-    
-    # Store token in database for potential blacklisting
-    store_token(db, user.id, access_token)
-    
-    return {
-        "access_token": access_token,
-        "token_type": "bearer",
-        "user_id": user.id,
-        "username": user.username
-    }
+    await ratelimit.refund_login(user_credentials.username)
+    return await issue_session_tokens(db, user)
+
+@app.post("/auth/refresh", response_model=Token)
+async def refresh(body: RefreshRequest, db: AsyncSession = Depends(get_db)):
+    """Trade a refresh token for a new access token and refresh token (no password check)"""
+    return await rotate_refresh_token(db, body.refresh_token)
 
 @app.post("/auth/logout", status_code=status.HTTP_200_OK)
 async def logout(
     credentials: HTTPAuthorizationCredentials = Depends(security),
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Logout and delete current token"""
     token = credentials.credentials
-    delete_token(db, token)
+    if TOKEN_MODE == "stateless":
+        # Stateless tokens can only be revoked all together
+        await revoke_all_tokens(db, current_user.id)
+    else:
+        await delete_token(db, token)
     return {"message": "Successfully logged out"}
 
+@app.post("/auth/logout-all", status_code=status.HTTP_200_OK)
+async def logout_all(
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_db)
+):
+    """Logout everywhere by revoking all of the current user's tokens"""
+    await revoke_all_tokens(db, current_user.id)
+    return {"message": "Successfully logged out from all sessions"}
+
 # User management endpoints
 @app.post("/users/", response_model=UserResponse, status_code=status.HTTP_201_CREATED)
-async def create_user(user: UserCreate, db: Session = Depends(get_db)):
+async def create_user(user: UserCreate, db: AsyncSession = Depends(get_db)):
     """Create a new user (no authentication required)"""
     try:
-        return crud.create_user(db=db, user=user)
+        return await crud.create_user(db=db, user=user)
     except ValueError as e:
         raise HTTPException(
             status_code=status.HTTP_400_BAD_REQUEST,
             detail=str(e)
         )
 
-@app.get("/users/", response_model=List[UserResponse])
+@app.post("/users/bulk", response_model=BulkUserResponse)
+async def create_users_bulk(
+    users: List[UserCreate],
+    current_user: User = Depends(get_current_user),
+    _: None = Depends(require_bulk_api_key),
+    db: AsyncSession = Depends(get_db)
+):
+    """Create many users at once - requires authentication and the partner API key
+
+    Each item gets its own result; duplicates are reported as conflicts
+    instead of failing the whole batch.
+    """
+    if len(users) > crud.BULK_CREATE_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {crud.BULK_CREATE_MAX} users can be created per request"
+        )
+    results = await crud.create_users_bulk(db, users)
+    # Let the caller list the new users before replicas catch up
+    database.mark_written(current_user.id)
+    created = sum(1 for result in results if result["status"] == "created")
+    return {"created": created, "conflicts": len(results) - created, "results": results}
+
+async def _users_batch(db: AsyncSession, ids: List[int], fields: Optional[str]):
+    """Resolve a list of user ids in request order"""
+    if len(ids) > crud.BATCH_FETCH_MAX:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail=f"At most {crud.BATCH_FETCH_MAX} ids can be requested at once"
+        )
+    selected = _parse_fields(fields)
+    users = await crud.get_users_by_ids(db, ids, fields=selected)
+    missing = [user_id for user_id, user in zip(ids, users) if user is None]
+    if selected:
+        model = user_fields_model(selected)
+        items = [jsonable_encoder(model(**user)) if user is not None else None for user in users]
+        return JSONResponse({"items": items, "missing": missing})
+    if serializers.FAST_JSON:
+        items = [serializers.user_dict(user) if user is not None else None for user in users]
+        return Response(content=serializers.dumps({"items": items, "missing": missing}), media_type="application/json")
+    return {"items": users, "missing": missing}
+
+@app.get("/users/batch", response_model=UserBatchResponse)
+async def get_users_batch(
+    ids: str,
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Get several users by a comma-separated id list - requires authentication
+
+    Items come back in request order, with null for ids that do not exist.
+    """
+    try:
+        user_ids = [int(user_id) for user_id in ids.split(",") if user_id.strip()]
+    except ValueError:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="ids must be a comma-separated list of integers"
+        )
+    return await _users_batch(db, user_ids, fields)
+
+@app.post("/users/batch", response_model=UserBatchResponse)
+async def post_users_batch(
+    batch: UserBatchRequest,
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Get several users by id, for lists too long for a query string - requires authentication"""
+    return await _users_batch(db, batch.ids, fields)
+
+async def _export_users(fields, export_format: str, read_only: bool):
+    """Yield the users table as NDJSON lines or CSV, one chunk per batch"""
+    async with session_scope(read_only=read_only) as db:
+        if export_format == "csv":
+            yield ",".join(fields) + "\r\n"
+        async for rows in crud.stream_users(db, fields):
+            if export_format == "csv":
+                buffer = io.StringIO()
+                writer = csv.writer(buffer)
+                writer.writerows([row[field] for field in fields] for row in rows)
+                yield buffer.getvalue()
+            else:
+                yield b"".join(serializers.dumps(dict(row)) + b"\n" for row in rows)
+
+@app.get("/users/export")
+async def export_users(
+    format: str = "ndjson",
+    fields: Optional[str] = None,
+    current_user: User = Depends(get_current_user)
+):
+    """Stream every user as NDJSON or CSV - requires authentication"""
+    if format not in ("ndjson", "csv"):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="format must be ndjson or csv"
+        )
+    selected = _parse_fields(fields) or tuple(UserResponse.model_fields)
+    media_type = "text/csv" if format == "csv" else "application/x-ndjson"
+    return StreamingResponse(
+        _export_users(selected, format, read_only=not database.wrote_recently(current_user.id)),
+        media_type=media_type,
+        headers={"Content-Disposition": f"attachment; filename=users.{format}"}
+    )
+
+@app.get("/users/search", response_model=UserSearchPage)
+async def search_users(
+    q: str,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(20, ge=1, le=crud.LIST_USERS_MAX),
+    current_user: User = Depends(get_current_user),
+    db: AsyncSession = Depends(get_read_db)
+):
+    """Search usernames, nicknames and about_me - requires authentication
+
+    Results are ranked by relevance; pass the returned `next_skip` as `skip`
+    to get the next page.
+    """
+    if not search.tokenize(q):
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="q must contain at least one word"
+        )
+    users, next_skip = await crud.search_users(db, q, skip=skip, limit=limit)
+    if serializers.FAST_JSON:
+        items = [serializers.user_dict(user) for user in users]
+        return Response(content=serializers.dumps({"items": items, "next_skip": next_skip}), media_type="application/json")
+    return {"items": users, "next_skip": next_skip}
+
+@app.get("/users/autocomplete", response_model=List[UserSuggestion])
+async def autocomplete_users(
+    prefix: str,
+    limit: int = Query(10, ge=1),
+    current_user: User = Depends(get_current_user)
+):
+    """Usernames and nicknames starting with `prefix` - requires authentication
+
+    Served from the in-process prefix index, built on the first call,
+    without a database query.
+    """
+    if not prefix:
+        raise HTTPException(
+            status_code=status.HTTP_400_BAD_REQUEST,
+            detail="prefix must not be empty"
+        )
+    await search.ensure_indexes()
+    return search.prefix_index.complete(prefix, min(limit, search.AUTOCOMPLETE_MAX))
+
+@app.get("/users/", response_model=Union[List[UserResponse], UserPage])
 async def get_users(
-    skip: int = 0, 
-    limit: int = 100, 
+    request: Request,
+    skip: int = Query(0, ge=0),
+    limit: int = Query(100, ge=1, le=crud.LIST_USERS_MAX),
+    cursor: Optional[str] = None,
+    fields: Optional[str] = None,
+    favorite: Optional[str] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """Get all users with pagination - requires authentication"""
-    users = crud.get_users(db, skip=skip, limit=limit)
-    return users
+    """Get all users with pagination - requires authentication
+
+    Pass `cursor` (empty for the first page) to use keyset pagination; the
+    response is then a page with `items` and a `next_cursor` for the next call.
+    Pass `fields` (e.g. `id,username,nickname`) to load and return only those columns.
+    Pass `favorite` (e.g. `coding`) to list only users with that favorite.
+    Responses carry an ETag; a matching If-None-Match gets 304 Not Modified.
+    """
+    selected = _parse_fields(fields)
+    if cursor is not None:
+        try:
+            after_id = crud.decode_cursor(cursor)
+        except ValueError as e:
+            raise HTTPException(
+                status_code=status.HTTP_400_BAD_REQUEST,
+                detail=str(e)
+            )
+        users, next_id = await crud.get_users_page(db, after_id=after_id, limit=limit, fields=selected, favorite=favorite)
+        next_cursor = crud.encode_cursor(next_id) if next_id is not None else None
+        if selected:
+            body = serializers.dumps({"items": _partial_users(users, selected), "next_cursor": next_cursor})
+        else:
+            body = serializers.page_json(users, next_cursor)
+        return http_cache.etag_response(request, body)
+    users = await crud.get_users(db, skip=skip, limit=limit, fields=selected, favorite=favorite)
+    if selected:
+        body = serializers.dumps(_partial_users(users, selected))
+    else:
+        body = serializers.users_json(users)
+    return http_cache.etag_response(request, body)
 
 @app.get("/users/{user_id}", response_model=UserResponse)
 async def get_user(
+    request: Request,
     user_id: int, 
+    fields: Optional[str] = None,
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_read_db)
 ):
-    """Get a specific user by ID - requires authentication"""
-    user = crud.get_user(db, user_id=user_id)
+    """Get a specific user by ID - requires authentication
+
+    Sends ETag and Last-Modified; If-None-Match / If-Modified-Since requests
+    that still match get 304 Not Modified after a timestamp-only lookup.
+    """
+    selected = _parse_fields(fields)
+    user_not_found = HTTPException(
+        status_code=status.HTTP_404_NOT_FOUND,
+        detail="User not found"
+    )
+    if "if-none-match" in request.headers or "if-modified-since" in request.headers:
+        version = await crud.get_user_version(db, user_id)
+        if version is None:
+            raise user_not_found
+        etag = http_cache.user_etag(version.id, version.version, fields=selected)
+        modified = http_cache.last_modified(version.created_at, version.updated_at)
+        if http_cache.is_not_modified(request, etag, modified):
+            return http_cache.not_modified(etag, modified)
+
+    # Partial loads still need the timestamps for the validators
+    columns = tuple(dict.fromkeys(selected + ("version", "created_at", "updated_at"))) if selected else None
+    user = await crud.get_user(db, user_id=user_id, fields=columns)
     if user is None:
-        raise HTTPException(
-            status_code=status.HTTP_404_NOT_FOUND,
-            detail="User not found"
-        )
-    return user
+        raise user_not_found
+    if selected:
+        etag = http_cache.user_etag(user["id"], user["version"], fields=selected)
+        modified = http_cache.last_modified(user["created_at"], user["updated_at"])
+        body = serializers.dumps(_partial_users([user], selected)[0])
+    else:
+        etag = http_cache.user_etag(user.id, user.version)
+        modified = http_cache.last_modified(user.created_at, user.updated_at)
+        body = serializers.user_json(user)
+    return Response(content=body, media_type="application/json", headers=http_cache.cache_headers(etag, modified))
 
 @app.put("/users/{user_id}", response_model=UserResponse)
 async def update_user(
+    request: Request,
+    response: Response,
     user_id: int, 
     user: UserUpdate, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Update a user (full update) - requires authentication"""
+    """Update a user (full update) - requires authentication
+
+    Send If-Match with the user's ETag to fail with 412 if it changed meanwhile.
+    """
     # Check if user is updating their own profile
     if current_user.id != user_id:
         raise HTTPException(
@@ -148,12 +457,12 @@ async def update_user(
         )
     
     try:
-        updated_user = crud.update_user(db=db, user_id=user_id, user=user)
+        updated_user = await crud.update_user(
+            db=db, user_id=user_id, user=user, versions=http_cache.if_match_versions(request, user_id)
+        )
         if updated_user is None:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found"
-            )
+            raise _user_not_updated(request)
+        _set_user_cache_headers(response, updated_user)
         return updated_user
     except ValueError as e:
         raise HTTPException(
@@ -163,12 +472,17 @@ async def update_user(
 
 @app.patch("/users/{user_id}", response_model=UserResponse)
 async def patch_user(
+    request: Request,
+    response: Response,
     user_id: int, 
     user: UserPatch, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
-    """Update a user (partial update) - requires authentication"""
+    """Update a user (partial update) - requires authentication
+
+    Send If-Match with the user's ETag to fail with 412 if it changed meanwhile.
+    """
     # Check if user is updating their own profile
     if current_user.id != user_id:
         raise HTTPException(
@@ -177,12 +491,12 @@ async def patch_user(
         )
     
     try:
-        updated_user = crud.patch_user(db=db, user_id=user_id, user=user)
+        updated_user = await crud.patch_user(
+            db=db, user_id=user_id, user=user, versions=http_cache.if_match_versions(request, user_id)
+        )
         if updated_user is None:
-            raise HTTPException(
-                status_code=status.HTTP_404_NOT_FOUND,
-                detail="User not found"
-            )
+            raise _user_not_updated(request)
+        _set_user_cache_headers(response, updated_user)
         return updated_user
     except ValueError as e:
         raise HTTPException(
@@ -194,7 +508,7 @@ async def patch_user(
 async def delete_user(
     user_id: int, 
     current_user: User = Depends(get_current_user),
-    db: Session = Depends(get_db)
+    db: AsyncSession = Depends(get_db)
 ):
     """Delete a user - requires authentication"""
     # Check if user is deleting their own profile
@@ -204,7 +518,7 @@ async def delete_user(
             detail="You can only delete your own profile"
         )
     
-    success = crud.delete_user(db=db, user_id=user_id)
+    success = await crud.delete_user(db=db, user_id=user_id)
     if not success:
         raise HTTPException(
             status_code=status.HTTP_404_NOT_FOUND,
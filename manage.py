@@ -0,0 +1,79 @@
+#!/usr/bin/env python3
+"""
+Management commands
+
+    python manage.py migrate               Create missing tables and apply schema changes
+    python manage.py backfill-favorites    Index users.favorites into user_favorites
+    python manage.py calibrate-hash        Measure password hashing cost on this host
+"""
+
+import argparse
+import asyncio
+from dotenv import load_dotenv
+
+# Load environment variables from .env file
+load_dotenv()
+
+async def migrate(args):
+    from migrations import migrate
+    from database import dispose
+    applied = await migrate()
+    await dispose()
+    for message in applied:
+        print(f"- {message}")
+    print("Database schema is up to date")
+
+async def backfill_favorites(args):
+    from migrations import FAVORITES_BACKFILL_BATCH_SIZE, backfill_user_favorites
+    from database import dispose
+    users = await backfill_user_favorites(args.batch_size or FAVORITES_BACKFILL_BATCH_SIZE)
+    await dispose()
+    print(f"Indexed the favorites of {users} users")
+
+# Cost parameter varied by calibrate-hash: scheme -> (setting, environment variable, values tried)
+CALIBRATION = {
+    "bcrypt": ("rounds", "BCRYPT_ROUNDS", range(8, 17)),
+    "argon2": ("time_cost", "ARGON2_TIME_COST", range(1, 11)),
+}
+
+async def calibrate_hash(args):
+    from passlib.registry import get_crypt_handler
+    import hashing
+    scheme = args.scheme or hashing.pwd_context.default_scheme()
+    if scheme not in CALIBRATION:
+        raise SystemExit(f"cannot calibrate {scheme}; choose one of {', '.join(CALIBRATION)}")
+    if not get_crypt_handler(scheme).has_backend():
+        raise SystemExit(f"{scheme} is not installed (argon2 needs argon2-cffi)")
+    setting, variable, values = CALIBRATION[scheme]
+    target = args.target_ms / 1000
+
+    print(f"{scheme}: median of 3 hashes per setting, target {args.target_ms} ms, {hashing.HASH_WORKERS} hashing workers")
+    chosen = None
+    for value in values:
+        seconds = hashing.measure_hash(scheme, **{setting: value})
+        print(f"  {variable}={value}: {seconds * 1000:.0f} ms, ~{hashing.HASH_WORKERS / seconds:.0f} logins/s")
+        if seconds > target:
+            break
+        chosen = value
+    if chosen is None:
+        print(f"Even the cheapest setting takes longer than {args.target_ms} ms")
+    else:
+        print(f"Suggested: {variable}={chosen} (existing hashes are upgraded as users log in)")
+
+def main():
+    parser = argparse.ArgumentParser(description="User Management API management commands")
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    commands.add_parser("migrate", help="create missing tables and apply schema changes")
+    backfill = commands.add_parser("backfill-favorites", help="index users.favorites into user_favorites (resumable)")
+    backfill.add_argument("--batch-size", type=int, help="users per transaction (default: FAVORITES_BACKFILL_BATCH_SIZE)")
+
+    calibrate = commands.add_parser("calibrate-hash", help="time password hashing at increasing cost and suggest a setting")
+    calibrate.add_argument("--target-ms", type=int, default=250, help="hash time budget per login (default: 250)")
+    calibrate.add_argument("--scheme", help="bcrypt or argon2 (default: the first of PASSWORD_SCHEMES)")
+
+    args = parser.parse_args()
+    asyncio.run(globals()[args.command.replace("-", "_")](args))
+
+if __name__ == "__main__":
+    main()
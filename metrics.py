@@ -0,0 +1,170 @@
+import os
+import time
+from bisect import bisect_left
+from typing import Dict, List, Tuple
+from sqlalchemy.pool import QueuePool
+import database
+import hashing
+
+# Prometheus text exposition for GET /metrics, written by hand so the
+# request path only touches a few preallocated counters
+
+# Upper bounds (seconds) of the request latency histogram buckets
+LATENCY_BUCKETS = tuple(
+    float(bound) for bound in os.getenv(
+        "METRICS_LATENCY_BUCKETS", "0.005,0.01,0.025,0.05,0.1,0.25,0.5,1,2.5,5,10"
+    ).split(",")
+)
+
+# Label used for requests that matched no route, so unknown paths
+# cannot grow the number of series
+UNMATCHED_ROUTE = "<unmatched>"
+
+class RouteSeries:
+    """Counters for one (method, route template) pair"""
+
+    __slots__ = ("statuses", "buckets", "count", "total")
+
+    def __init__(self):
+        self.statuses: Dict[int, int] = {}
+        # One slot per bucket plus +Inf; cumulated only when scraped
+        self.buckets: List[int] = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.count = 0
+        self.total = 0.0
+
+    def observe(self, status_code: int, seconds: float):
+        self.statuses[status_code] = self.statuses.get(status_code, 0) + 1
+        self.buckets[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+
+# Updated only from the event loop, so plain ints need no locking
+_series: Dict[Tuple[str, str], RouteSeries] = {}
+
+def observe(method: str, route: str, status_code: int, seconds: float):
+    """Record one finished request"""
+    series = _series.get((method, route))
+    if series is None:
+        series = _series[(method, route)] = RouteSeries()
+    series.observe(status_code, seconds)
+
+class MetricsMiddleware:
+    """ASGI middleware timing every HTTP request by its route template"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+            await send(message)
+
+        start = time.perf_counter()
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            # The router stores the matched route in the shared scope
+            route = scope.get("route")
+            observe(
+                scope["method"],
+                getattr(route, "path", UNMATCHED_ROUTE),
+                status_code,
+                time.perf_counter() - start,
+            )
+
+def _labels(**labels) -> str:
+    return ",".join(f'{name}="{value}"' for name, value in labels.items())
+
+def _format_bound(bound: float) -> str:
+    return repr(bound) if bound != int(bound) else f"{bound:.1f}"
+
+def _http_lines() -> List[str]:
+    lines = [
+        "# HELP http_requests_total Requests handled, by route template and status code",
+        "# TYPE http_requests_total counter",
+    ]
+    series = sorted(_series.items())
+    for (method, route), route_series in series:
+        for status_code, count in sorted(route_series.statuses.items()):
+            lines.append(f"http_requests_total{{{_labels(method=method, route=route, status=status_code)}}} {count}")
+
+    lines += [
+        "# HELP http_request_duration_seconds Request latency, by route template",
+        "# TYPE http_request_duration_seconds histogram",
+    ]
+    for (method, route), route_series in series:
+        labels = _labels(method=method, route=route)
+        cumulative = 0
+        for bound, count in zip(LATENCY_BUCKETS, route_series.buckets):
+            cumulative += count
+            lines.append(f'http_request_duration_seconds_bucket{{{labels},le="{_format_bound(bound)}"}} {cumulative}')
+        lines.append(f'http_request_duration_seconds_bucket{{{labels},le="+Inf"}} {route_series.count}')
+        lines.append(f"http_request_duration_seconds_sum{{{labels}}} {route_series.total}")
+        lines.append(f"http_request_duration_seconds_count{{{labels}}} {route_series.count}")
+    return lines
+
+# name -> (help, how to read it from a QueuePool)
+POOL_GAUGES = {
+    "db_pool_size": ("Connections the pool keeps open", lambda pool: pool.size()),
+    "db_pool_checked_out": ("Connections currently in use", lambda pool: pool.checkedout()),
+    "db_pool_checked_in": ("Idle connections in the pool", lambda pool: pool.checkedin()),
+    "db_pool_overflow": ("Connections open beyond pool_size (negative while the pool is filling)", lambda pool: pool.overflow()),
+    "db_pool_waiters": ("Callers waiting for a connection", lambda pool: getattr(pool, "waiters", 0)),
+}
+
+# name -> (help, how to read it from an instrumented pool)
+POOL_COUNTERS = {
+    "db_pool_checkouts_total": ("Connection checkouts", lambda pool: pool.checkouts),
+    "db_pool_checkout_timeouts_total": ("Checkouts that gave up after DB_POOL_TIMEOUT", lambda pool: pool.timeouts),
+    "db_pool_checkout_wait_seconds_total": ("Time spent waiting for a connection", lambda pool: pool.wait_total),
+}
+
+def _pool_lines() -> List[str]:
+    pools = {
+        name: engine.pool
+        for name, engine in database.active_engines().items()
+        if isinstance(engine.pool, QueuePool)
+    }
+    lines = []
+    for metric, (help_text, read) in POOL_GAUGES.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} gauge"]
+        for name, pool in pools.items():
+            lines.append(f"{metric}{{{_labels(engine=name)}}} {read(pool)}")
+    for metric, (help_text, read) in POOL_COUNTERS.items():
+        lines += [f"# HELP {metric} {help_text}", f"# TYPE {metric} counter"]
+        for name, pool in pools.items():
+            if isinstance(pool, database.InstrumentedPool):
+                lines.append(f"{metric}{{{_labels(engine=name)}}} {read(pool)}")
+    return lines
+
+def _hashing_lines() -> List[str]:
+    stats = hashing.stats()
+    return [
+        "# HELP password_hash_waiting Hash operations queued for a pool worker",
+        "# TYPE password_hash_waiting gauge",
+        f"password_hash_waiting {stats['waiting']}",
+        "# HELP password_hash_running Hash operations currently running",
+        "# TYPE password_hash_running gauge",
+        f"password_hash_running {stats['running']}",
+        "# HELP password_hash_waiting_max Highest queue depth seen",
+        "# TYPE password_hash_waiting_max gauge",
+        f"password_hash_waiting_max {stats['max_waiting']}",
+        "# HELP password_hash_completed_total Hash operations completed",
+        "# TYPE password_hash_completed_total counter",
+        f"password_hash_completed_total {stats['completed']}",
+        "# HELP password_hash_rejected_total Hash operations refused because the queue was full",
+        "# TYPE password_hash_rejected_total counter",
+        f"password_hash_rejected_total {stats['rejected']}",
+    ]
+
+def render() -> str:
+    """All metrics in the Prometheus text format"""
+    return "\n".join(_http_lines() + _pool_lines() + _hashing_lines()) + "\n"
@@ -0,0 +1,121 @@
+import os
+from typing import List, Optional
+from sqlalchemy import exists, insert, inspect, select, text
+from database import run_schema, session_scope
+from models import Base, User, UserFavorite
+from schemas import split_favorites
+
+# Schema migrations, run explicitly with `python manage.py migrate`.
+# Each step inspects the live schema and only acts when it is out of date,
+# so migrate is safe to run on every deploy.
+
+# Users read per transaction when filling user_favorites from users.favorites
+FAVORITES_BACKFILL_BATCH_SIZE = int(os.getenv("FAVORITES_BACKFILL_BATCH_SIZE", "1000"))
+
+def _columns(inspector, table: str) -> set:
+    return {column["name"] for column in inspector.get_columns(table)}
+
+def recreate_tokens_table(conn, inspector) -> Optional[str]:
+    """tokens used to store the whole JWT; its rows are short-lived, so rebuild it keyed on jti"""
+    if "tokens" in inspector.get_table_names() and "jti" not in _columns(inspector, "tokens"):
+        conn.execute(text("DROP TABLE tokens"))
+        return "dropped legacy tokens table (users must log in again)"
+    return None
+
+def add_users_token_version(conn, inspector) -> Optional[str]:
+    if "token_version" not in _columns(inspector, "users"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN token_version INTEGER NOT NULL DEFAULT 0"))
+        return "added users.token_version"
+    return None
+
+def add_users_version(conn, inspector) -> Optional[str]:
+    if "version" not in _columns(inspector, "users"):
+        conn.execute(text("ALTER TABLE users ADD COLUMN version INTEGER NOT NULL DEFAULT 0"))
+        return "added users.version"
+    return None
+
+def add_tokens_family_id(conn, inspector) -> Optional[str]:
+    """Login session of each access token, so a session can be revoked on its own"""
+    if "family_id" not in _columns(inspector, "tokens"):
+        conn.execute(text("ALTER TABLE tokens ADD COLUMN family_id CHAR(32)"))
+        conn.execute(text("CREATE INDEX ix_tokens_family_id ON tokens (family_id)"))
+        return "added tokens.family_id"
+    return None
+
+def add_users_search_index(conn, inspector) -> Optional[str]:
+    """FULLTEXT index behind GET /users/search (MySQL only)"""
+    if conn.dialect.name != "mysql":
+        return None
+    if "ix_users_search" not in {index["name"] for index in inspector.get_indexes("users")}:
+        conn.execute(text("ALTER TABLE users ADD FULLTEXT INDEX ix_users_search (username, nickname, about_me)"))
+        return "added FULLTEXT index users.ix_users_search"
+    return None
+
+# Steps that must run before missing tables are created
+BEFORE_CREATE = [recreate_tokens_table]
+# Steps that alter tables which already existed
+AFTER_CREATE = [add_users_token_version, add_users_version, add_tokens_family_id, add_users_search_index]
+
+def _upgrade(conn) -> List[str]:
+    applied = []
+    for step in BEFORE_CREATE:
+        message = step(conn, inspect(conn))
+        if message:
+            applied.append(message)
+    Base.metadata.create_all(conn)
+    for step in AFTER_CREATE:
+        message = step(conn, inspect(conn))
+        if message:
+            applied.append(message)
+    return applied
+
+def _favorites_need_backfill(conn) -> bool:
+    """user_favorites is empty while some users have favorites (e.g. it was just created)"""
+    if conn.execute(select(UserFavorite.user_id).limit(1)).first() is not None:
+        return False
+    with_favorites = select(User.id).where(User.favorites.isnot(None), User.favorites != "").limit(1)
+    return conn.execute(with_favorites).first() is not None
+
+async def backfill_user_favorites(batch_size: int = FAVORITES_BACKFILL_BATCH_SIZE) -> int:
+    """Fill user_favorites from users.favorites in id order, one transaction per batch.
+
+    Users that already have rows are skipped, so an interrupted run can be
+    repeated. Returns how many users were read.
+    """
+    last_id = 0
+    users = 0
+    async with session_scope() as db:
+        while True:
+            result = await db.execute(
+                select(User.id, User.favorites)
+                .where(
+                    User.id > last_id,
+                    User.favorites.isnot(None),
+                    User.favorites != "",
+                    ~exists().where(UserFavorite.user_id == User.id)
+                )
+                .order_by(User.id)
+                .limit(batch_size)
+            )
+            rows = result.all()
+            if not rows:
+                break
+            values = [
+                {"user_id": row.id, "favorite": favorite}
+                for row in rows
+                for favorite in split_favorites(row.favorites)
+            ]
+            if values:
+                await db.execute(insert(UserFavorite).values(values))
+            await db.commit()
+            last_id = rows[-1].id
+            users += len(rows)
+    return users
+
+async def migrate() -> List[str]:
+    """Create missing tables and apply pending steps; returns what was done"""
+    applied = await run_schema(_upgrade)
+    if await run_schema(_favorites_need_backfill):
+        users = await backfill_user_favorites()
+        applied.append(f"backfilled user_favorites from {users} users")
+    return applied
@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, Text, Date, DateTime, ForeignKey
+from sqlalchemy import Column, Integer, String, CHAR, Text, Date, DateTime, ForeignKey, Index
 from sqlalchemy.ext.declarative import declarative_base
 from sqlalchemy.sql import func
 from sqlalchemy.orm import relationship
@@ -16,20 +16,52 @@ class User(Base):
     about_me = Column(Text, nullable=True)
     gender = Column(String(10), nullable=True)
     birthdate = Column(Date, nullable=True)
-    favorites = Column(Text, nullable=True)  # JSON string or comma-separated values
+    favorites = Column(Text, nullable=True)  # JSON string or comma-separated values (indexed in user_favorites)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     updated_at = Column(DateTime(timezone=True), onupdate=func.now())
+    token_version = Column(Integer, nullable=False, default=0, server_default="0")  # bumped to revoke all tokens
+    version = Column(Integer, nullable=False, default=0, server_default="0")  # bumped by every update; the user's ETag
     
     # Relationship to tokens (for potential blacklisting)
-    tokens = relationship("Token", back_populates="user")
+    tokens = relationship("Token", back_populates="user", passive_deletes=True)
+
+    __table_args__ = (
+        # GET /users/search on MySQL; other databases use search.InvertedIndex
+        Index("ix_users_search", "username", "nickname", "about_me", mysql_prefix="FULLTEXT").ddl_if(dialect="mysql"),
+    )
+
+class UserFavorite(Base):
+    """One normalised entry of User.favorites, for lookups by favorite"""
+    __tablename__ = "user_favorites"
+
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), primary_key=True)
+    favorite = Column(String(100), primary_key=True)
+
+    __table_args__ = (
+        # GET /users/?favorite= walks this index in user id order
+        Index("ix_user_favorites_favorite", "favorite", "user_id"),
+    )
 
 class Token(Base):
     __tablename__ = "tokens"
     
-    id = Column(Integer, primary_key=True, index=True)
-    token = Column(String(500), unique=True, index=True, nullable=False)
-    user_id = Column(Integer, ForeignKey("users.id"), nullable=False)
+    jti = Column(CHAR(32), primary_key=True)  # JWT ID (uuid4 hex)
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    family_id = Column(CHAR(32), nullable=True, index=True)  # login session (sid claim) the token belongs to
+    expires_at = Column(DateTime, nullable=False, index=True)
     created_at = Column(DateTime(timezone=True), server_default=func.now())
     
     # Relationship to user
-    user = relationship("User", back_populates="tokens") 
\ No newline at end of file
+    user = relationship("User", back_populates="tokens")
+
+class RefreshToken(Base):
+    """One-time-use refresh token; each POST /auth/refresh replaces it with a new one in the same family"""
+    __tablename__ = "refresh_tokens"
+
+    token_hash = Column(CHAR(64), primary_key=True)  # sha256 of the opaque token; the token itself is never stored
+    family_id = Column(CHAR(32), nullable=False, index=True)  # login session, shared by every rotation
+    user_id = Column(Integer, ForeignKey("users.id", ondelete="CASCADE"), nullable=False, index=True)
+    token_version = Column(Integer, nullable=False)  # users.token_version at issue; logout-all makes it stale
+    expires_at = Column(DateTime, nullable=False, index=True)
+    used_at = Column(DateTime, nullable=True)  # set on rotation; presenting it again revokes the family
+    created_at = Column(DateTime(timezone=True), server_default=func.now()) 
\ No newline at end of file
@@ -0,0 +1,109 @@
+import importlib
+import os
+import time
+from typing import Optional
+from cache import TTLCache
+
+# Login throttling: token buckets refilled at N attempts per minute, holding
+# at most BURST. Both buckets are charged before the password is checked; the
+# username bucket is refunded when the attempt does not fail, so only failed
+# attempts count against an account. A rate of 0 disables that limit.
+LOGIN_IP_PER_MINUTE = float(os.getenv("LOGIN_IP_PER_MINUTE", "20"))
+LOGIN_IP_BURST = float(os.getenv("LOGIN_IP_BURST", "20"))
+LOGIN_USER_PER_MINUTE = float(os.getenv("LOGIN_USER_PER_MINUTE", "5"))
+LOGIN_USER_BURST = float(os.getenv("LOGIN_USER_BURST", "5"))
+
+# Request header carrying the client address, set by a trusted proxy in front
+# of the app (e.g. x-real-ip on Vercel). Unset, the socket peer is used, which
+# uvicorn rewrites from X-Forwarded-For for proxies in --forwarded-allow-ips.
+RATE_LIMIT_CLIENT_IP_HEADER = os.getenv("RATE_LIMIT_CLIENT_IP_HEADER", "").lower()
+
+# "memory" (per worker process) or "module:factory" returning a shared backend
+RATE_LIMIT_BACKEND = os.getenv("RATE_LIMIT_BACKEND", "memory")
+# Buckets kept by the memory backend; evicting one resets it to full
+RATE_LIMIT_MAX_KEYS = int(os.getenv("RATE_LIMIT_MAX_KEYS", "100000"))
+
+class RateLimited(Exception):
+    """The caller must wait `retry_after` seconds"""
+
+    def __init__(self, retry_after: float):
+        super().__init__("Too many login attempts, try again later")
+        self.retry_after = retry_after
+
+class MemoryBackend:
+    """Token buckets in a bounded in-process LRU.
+
+    A shared backend (e.g. Redis) implements the same two coroutines so
+    limits hold across worker processes; take() must be atomic per key.
+    """
+
+    def __init__(self, maxsize: int = RATE_LIMIT_MAX_KEYS):
+        # key -> (tokens, monotonic time of that count); idle buckets are full after an hour
+        self._buckets = TTLCache(maxsize, 3600)
+
+    def _tokens(self, key: str, rate: float, burst: float, now: float) -> float:
+        state = self._buckets.get(key)
+        if state is None:
+            return burst
+        tokens, updated = state
+        return min(burst, tokens + (now - updated) * rate)
+
+    async def take(self, key: str, rate: float, burst: float, cost: float = 1.0) -> float:
+        """Spend `cost` tokens; returns 0, or the seconds until they are available"""
+        now = time.monotonic()
+        tokens = self._tokens(key, rate, burst, now)
+        if tokens < cost:
+            return (cost - tokens) / rate
+        self._buckets.set(key, (tokens - cost, now))
+        return 0.0
+
+    async def refund(self, key: str, rate: float, burst: float, amount: float = 1.0):
+        """Give back tokens spent by take(), up to `burst`"""
+        now = time.monotonic()
+        self._buckets.set(key, (min(burst, self._tokens(key, rate, burst, now) + amount), now))
+
+_backend = None
+
+def get_backend():
+    """The configured backend, created on first use"""
+    global _backend
+    if _backend is None:
+        if RATE_LIMIT_BACKEND == "memory":
+            _backend = MemoryBackend()
+        else:
+            module_name, _, factory = RATE_LIMIT_BACKEND.partition(":")
+            _backend = getattr(importlib.import_module(module_name), factory)()
+    return _backend
+
+def client_ip(request) -> Optional[str]:
+    """Address the per-IP login bucket is keyed on"""
+    if RATE_LIMIT_CLIENT_IP_HEADER:
+        value = request.headers.get(RATE_LIMIT_CLIENT_IP_HEADER)
+        if value:
+            # In a list, the last entry is the one the trusted proxy appended
+            return value.split(",")[-1].strip()
+    return request.client.host if request.client else None
+
+def _user_key(username: str) -> str:
+    return f"login:user:{username.strip().lower()}"
+
+async def check_login(client_ip: Optional[str], username: str):
+    """Charge a login attempt, raising RateLimited before it spends any password hashing.
+
+    The username's token is taken up front, so concurrent guesses cannot all
+    pass; call refund_login() once the attempt turns out not to have failed.
+    """
+    backend = get_backend()
+    if LOGIN_IP_PER_MINUTE > 0 and client_ip:
+        wait = await backend.take(f"login:ip:{client_ip}", LOGIN_IP_PER_MINUTE / 60, LOGIN_IP_BURST)
+        if wait:
+            raise RateLimited(wait)
+    if LOGIN_USER_PER_MINUTE > 0:
+        wait = await backend.take(_user_key(username), LOGIN_USER_PER_MINUTE / 60, LOGIN_USER_BURST)
+        if wait:
+            raise RateLimited(wait)
+
+async def refund_login(username: str):
+    """Return the username's token for an attempt that succeeded (or never checked the password)"""
+    if LOGIN_USER_PER_MINUTE > 0:
+        await get_backend().refund(_user_key(username), LOGIN_USER_PER_MINUTE / 60, LOGIN_USER_BURST)
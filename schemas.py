@@ -1,5 +1,7 @@
-from pydantic import BaseModel, EmailStr, validator
-from typing import Optional
+import json
+from functools import lru_cache
+from pydantic import BaseModel, EmailStr, TypeAdapter, create_model, validator
+from typing import List, Optional, Tuple, Type
 from datetime import date, datetime
 
 class UserBase(BaseModel):
@@ -46,6 +48,79 @@ class UserResponse(UserBase):
     class Config:
         from_attributes = True
 
+# Serialises a list of User rows straight to JSON bytes
+UserListAdapter = TypeAdapter(List[UserResponse])
+
+def parse_user_fields(fields: str) -> Tuple[str, ...]:
+    """Parse a comma-separated `fields=` value into UserResponse field names.
+
+    `id` is always included; unknown names raise ValueError.
+    """
+    requested = [name.strip() for name in fields.split(",") if name.strip()]
+    unknown = [name for name in requested if name not in UserResponse.model_fields]
+    if unknown:
+        raise ValueError(f"Unknown fields: {', '.join(unknown)}")
+    return tuple(name for name in UserResponse.model_fields if name == "id" or name in requested)
+
+def normalize_favorite(favorite: str) -> str:
+    """Form stored in user_favorites and used for GET /users/?favorite="""
+    return favorite.strip().lower()[:100]
+
+def split_favorites(favorites: Optional[str]) -> List[str]:
+    """Distinct normalised entries of a favorites value (JSON list or comma-separated)"""
+    if not favorites:
+        return []
+    items = None
+    if favorites.lstrip().startswith("["):
+        try:
+            items = json.loads(favorites)
+        except ValueError:
+            pass
+    if not isinstance(items, list):
+        items = favorites.split(",")
+    normalized = (normalize_favorite(str(item)) for item in items)
+    return list(dict.fromkeys(item for item in normalized if item))
+
+@lru_cache(maxsize=128)
+def user_fields_model(fields: Tuple[str, ...]) -> Type[BaseModel]:
+    """Reduced UserResponse model containing only the given fields"""
+    definitions = {}
+    for name in fields:
+        field = UserResponse.model_fields[name]
+        definitions[name] = (field.annotation, field.default if not field.is_required() else ...)
+    return create_model("UserFields", **definitions)
+
+class UserPage(BaseModel):
+    items: List[UserResponse]
+    next_cursor: Optional[str] = None
+
+class UserSearchPage(BaseModel):
+    items: List[UserResponse]
+    next_skip: Optional[int] = None
+
+class UserSuggestion(BaseModel):
+    id: int
+    username: str
+    nickname: Optional[str] = None
+
+class UserBatchRequest(BaseModel):
+    ids: List[int]
+
+class UserBatchResponse(BaseModel):
+    items: List[Optional[UserResponse]]  # in request order, null for missing ids
+    missing: List[int]
+
+class BulkUserResult(BaseModel):
+    index: int
+    status: str  # "created" or "conflict"
+    id: Optional[int] = None
+    detail: Optional[str] = None
+
+class BulkUserResponse(BaseModel):
+    created: int
+    conflicts: int
+    results: List[BulkUserResult]
+
 # Authentication schemas
 class UserLogin(BaseModel):
     username: str
@@ -53,10 +128,16 @@ class UserLogin(BaseModel):
 
 class Token(BaseModel):
     access_token: str
+    refresh_token: str
     token_type: str = "bearer"
     user_id: int
     username: str
 
+class RefreshRequest(BaseModel):
+    refresh_token: str
+
 class TokenData(BaseModel):
     username: Optional[str] = None
-    user_id: Optional[int] = None 
\ No newline at end of file
+    user_id: Optional[int] = None
+    jti: Optional[str] = None
+    token_version: Optional[int] = None 
\ No newline at end of file
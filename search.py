@@ -0,0 +1,227 @@
+import asyncio
+import heapq
+import math
+import os
+import re
+from bisect import bisect_left, insort
+from collections import Counter
+from typing import Dict, List, Optional, Tuple
+from sqlalchemy import select
+import database
+from database import session_scope
+from models import User
+
+# GET /users/search backend: "fulltext" uses the MySQL FULLTEXT index,
+# "memory" an in-process inverted index built on first use; "auto" picks
+# fulltext on MySQL and memory otherwise (SQLite / local development)
+SEARCH_BACKEND = os.getenv("SEARCH_BACKEND", "auto").lower()
+# Rows read per round trip while building the in-process indexes
+SEARCH_INDEX_BATCH_SIZE = int(os.getenv("SEARCH_INDEX_BATCH_SIZE", "1000"))
+# Rebuild the in-process indexes this often once they are in use (0 = never);
+# each worker process updates its own indexes, so this picks up other workers'
+# writes. A rebuild rescans the users table and briefly holds two copies.
+SEARCH_INDEX_REFRESH_SECONDS = int(os.getenv("SEARCH_INDEX_REFRESH_SECONDS", "900"))
+# Most suggestions returned by GET /users/autocomplete
+AUTOCOMPLETE_MAX = int(os.getenv("AUTOCOMPLETE_MAX", "20"))
+
+_token_pattern = re.compile(r"\w+")
+
+def use_fulltext() -> bool:
+    if SEARCH_BACKEND == "auto":
+        return database.DATABASE_URL.startswith("mysql")
+    return SEARCH_BACKEND == "fulltext"
+
+def tokenize(text: Optional[str]) -> List[str]:
+    return _token_pattern.findall(text.lower()) if text else []
+
+class InvertedIndex:
+    """Token -> {user_id: weight} postings over username, nickname and about_me.
+
+    Ranked with TF-IDF: each query token adds its field-weighted count in the
+    profile times log(1 + users / users with the token). Only updated from the
+    event loop, so it needs no locking.
+    """
+
+    def __init__(self):
+        self.postings: Dict[str, Dict[int, int]] = {}
+        self.documents: Dict[int, Counter] = {}
+        self.ready = False
+
+    def add(self, user_id: int, username: Optional[str], nickname: Optional[str], about_me: Optional[str]):
+        """Index a user, replacing what was indexed for it before"""
+        self.remove(user_id)
+        terms = Counter()
+        # Matches in the username count more than in the nickname or about_me
+        for text, weight in ((username, 3), (nickname, 2), (about_me, 1)):
+            for token in tokenize(text):
+                terms[token] += weight
+        self.documents[user_id] = terms
+        for token, weight in terms.items():
+            self.postings.setdefault(token, {})[user_id] = weight
+
+    def remove(self, user_id: int):
+        for token in self.documents.pop(user_id, ()):
+            posting = self.postings[token]
+            posting.pop(user_id, None)
+            if not posting:
+                del self.postings[token]
+
+    def search(self, query: str, offset: int = 0, limit: int = 20) -> List[int]:
+        """User ids matching any query token, best first (ties by id)"""
+        scores: Dict[int, float] = {}
+        total = len(self.documents)
+        for token in set(tokenize(query)):
+            posting = self.postings.get(token)
+            if not posting:
+                continue
+            idf = math.log(1 + total / len(posting))
+            for user_id, weight in posting.items():
+                scores[user_id] = scores.get(user_id, 0.0) + weight * idf
+        ranked = heapq.nsmallest(offset + limit, scores.items(), key=lambda item: (-item[1], item[0]))
+        return [user_id for user_id, _ in ranked[offset:]]
+
+class PrefixIndex:
+    """Sorted (lowercased name, user_id) entries over usernames and nicknames.
+
+    A prefix lookup is one binary search plus a scan of at most `limit`
+    matches; results come in alphabetical order, so exact and shorter names
+    come first.
+    """
+
+    def __init__(self):
+        self.entries: List[Tuple[str, int]] = []
+        self.users: Dict[int, Tuple[str, Optional[str]]] = {}
+        self.ready = False
+
+    @staticmethod
+    def _keys(username: Optional[str], nickname: Optional[str]) -> set:
+        return {name.lower() for name in (username, nickname) if name}
+
+    def add(self, user_id: int, username: str, nickname: Optional[str]):
+        """Index a user, replacing its previous names"""
+        self.remove(user_id)
+        self.users[user_id] = (username, nickname)
+        for key in self._keys(username, nickname):
+            insort(self.entries, (key, user_id))
+
+    def extend(self, rows):
+        """Bulk-load (id, username, nickname) rows of new users, sorting once"""
+        for user_id, username, nickname in rows:
+            self.users[user_id] = (username, nickname)
+            self.entries.extend((key, user_id) for key in self._keys(username, nickname))
+        self.entries.sort()
+
+    def remove(self, user_id: int):
+        names = self.users.pop(user_id, None)
+        if names is None:
+            return
+        for key in self._keys(*names):
+            position = bisect_left(self.entries, (key, user_id))
+            if position < len(self.entries) and self.entries[position] == (key, user_id):
+                del self.entries[position]
+
+    def complete(self, prefix: str, limit: int = 10) -> List[dict]:
+        """Up to `limit` users whose username or nickname starts with `prefix`"""
+        prefix = prefix.lower()
+        matches = []
+        seen = set()
+        position = bisect_left(self.entries, (prefix,))
+        while position < len(self.entries) and len(matches) < limit:
+            key, user_id = self.entries[position]
+            if not key.startswith(prefix):
+                break
+            if user_id not in seen:
+                seen.add(user_id)
+                username, nickname = self.users[user_id]
+                matches.append({"id": user_id, "username": username, "nickname": nickname})
+            position += 1
+        return matches
+
+index = InvertedIndex()
+prefix_index = PrefixIndex()
+
+# Writes made while build_indexes() reads the table, replayed onto the new
+# indexes: user_id -> (username, nickname, about_me), or None once deleted
+_pending: Optional[Dict[int, Optional[Tuple[str, Optional[str], Optional[str]]]]] = None
+_building: Optional[asyncio.Task] = None
+
+async def build_indexes():
+    """Load every user into the in-process indexes in one pass.
+
+    The prefix index is always built; the inverted index only for the memory
+    search backend. The new indexes replace the current ones when complete.
+    """
+    global index, prefix_index, _pending
+    new_index = InvertedIndex() if not use_fulltext() else None
+    new_prefix_index = PrefixIndex()
+    # about_me (TEXT) is only read when the inverted index needs it
+    columns = [User.id, User.username, User.nickname] + ([User.about_me] if new_index is not None else [])
+    statement = select(*columns).execution_options(yield_per=SEARCH_INDEX_BATCH_SIZE)
+    _pending = {}
+    try:
+        async with session_scope(read_only=True) as db:
+            result = await db.stream(statement)
+            async for rows in result.partitions():
+                new_prefix_index.extend((row.id, row.username, row.nickname) for row in rows)
+                if new_index is not None:
+                    for row in rows:
+                        new_index.add(row.id, row.username, row.nickname, row.about_me)
+        new_prefix_index.ready = True
+        prefix_index = new_prefix_index
+        if new_index is not None:
+            new_index.ready = True
+            index = new_index
+        pending, _pending = _pending, None
+        for user_id, names in pending.items():
+            if names is None:
+                user_deleted(user_id)
+            else:
+                user_changed(User(id=user_id, username=names[0], nickname=names[1], about_me=names[2]))
+    finally:
+        _pending = None
+
+async def ensure_indexes():
+    """Build the indexes on first use, so startup does not read the users table.
+
+    Concurrent first callers share one build; a failed build is retried by
+    the next call.
+    """
+    global _building
+    if prefix_index.ready:
+        return
+    if _building is None or _building.done():
+        _building = asyncio.ensure_future(build_indexes())
+    # A cancelled request must not cancel the build other callers wait for
+    await asyncio.shield(_building)
+
+async def refresh_indexes_forever():
+    """Background task: rebuild the indexes every SEARCH_INDEX_REFRESH_SECONDS.
+
+    Picks up writes made by other worker processes. Indexes that were never
+    used are left unbuilt.
+    """
+    while True:
+        await asyncio.sleep(SEARCH_INDEX_REFRESH_SECONDS)
+        if not prefix_index.ready:
+            continue
+        try:
+            await build_indexes()
+        except Exception as e:
+            print(f"WARNING: search index refresh failed: {e}")
+
+def user_changed(user: User):
+    """Keep the in-process indexes current after a create or update"""
+    if _pending is not None:
+        _pending[user.id] = (user.username, user.nickname, user.about_me)
+    if index.ready:
+        index.add(user.id, user.username, user.nickname, user.about_me)
+    if prefix_index.ready:
+        prefix_index.add(user.id, user.username, user.nickname)
+
+def user_deleted(user_id: int):
+    if _pending is not None:
+        _pending[user_id] = None
+    if index.ready:
+        index.remove(user_id)
+    if prefix_index.ready:
+        prefix_index.remove(user_id)
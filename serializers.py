@@ -0,0 +1,52 @@
+import json
+import os
+from datetime import date
+from operator import attrgetter
+from typing import Iterable, List, Optional
+from schemas import UserPage, UserResponse, UserListAdapter
+
+try:
+    import orjson
+except ImportError:  # optional dependency
+    orjson = None
+
+# Opt-in fast path: serialise trusted User rows directly with orjson,
+# skipping the per-row pydantic validation of UserResponse
+FAST_JSON = os.getenv("FAST_JSON", "false").lower() in ("1", "true", "yes", "on") and orjson is not None
+
+USER_FIELDS = tuple(UserResponse.model_fields)
+_user_values = attrgetter(*USER_FIELDS)
+
+def _json_default(value):
+    if isinstance(value, date):
+        return value.isoformat()
+    raise TypeError(f"Object of type {type(value).__name__} is not JSON serializable")
+
+def dumps(content) -> bytes:
+    """Compact JSON bytes for plain content (dicts, lists, dates)"""
+    if orjson is not None:
+        return orjson.dumps(content)
+    return json.dumps(content, ensure_ascii=False, separators=(",", ":"), default=_json_default).encode()
+
+def user_dict(user) -> dict:
+    """UserResponse fields of a User row, without validation"""
+    return dict(zip(USER_FIELDS, _user_values(user)))
+
+def user_json(user) -> bytes:
+    """One User row as UserResponse JSON"""
+    if FAST_JSON:
+        return orjson.dumps(user_dict(user))
+    return UserResponse.model_validate(user).model_dump_json().encode()
+
+def users_json(users: Iterable) -> bytes:
+    """A list of User rows as List[UserResponse] JSON"""
+    if FAST_JSON:
+        return orjson.dumps([user_dict(user) for user in users])
+    return UserListAdapter.dump_json(UserListAdapter.validate_python(users))
+
+def page_json(users: List, next_cursor: Optional[str]) -> bytes:
+    """A keyset page of User rows as UserPage JSON"""
+    if FAST_JSON:
+        return orjson.dumps({"items": [user_dict(user) for user in users], "next_cursor": next_cursor})
+    page = UserPage.model_validate({"items": users, "next_cursor": next_cursor})
+    return page.model_dump_json().encode()
@@ -1,5 +1,6 @@
 import requests
 import json
+import uuid
 
 # API base URL
 BASE_URL = "http://localhost:8000"
@@ -116,6 +117,164 @@ def test_authentication_flow():
     else:
         print(f"❌ Logout failed: {response.text}")
 
+def test_renamed_username():
+    """A token must keep pointing at its user after someone else takes the username"""
+
+    print("🔐 Testing Token After Username Change\n")
+
+    suffix = uuid.uuid4().hex[:8]
+    first = {"username": f"first_{suffix}", "email": f"first_{suffix}@example.com", "password": "securepassword123"}
+    second = {"username": f"second_{suffix}", "email": f"second_{suffix}@example.com", "password": "securepassword123"}
+
+    # 1. Create two users and log in as both
+    print("1. Creating two users and logging in...")
+    ids, headers = [], []
+    for user_data in (first, second):
+        response = requests.post(f"{BASE_URL}/users/", json=user_data)
+        if response.status_code != 201:
+            print(f"❌ Failed to create user: {response.text}")
+            return
+        ids.append(response.json()["id"])
+        response = requests.post(f"{BASE_URL}/auth/login", json={"username": user_data["username"], "password": user_data["password"]})
+        if response.status_code != 200:
+            print(f"❌ Login failed: {response.text}")
+            return
+        headers.append({"Authorization": f"Bearer {response.json()['access_token']}"})
+    print("✅ Both users logged in")
+
+    print("\n" + "="*50 + "\n")
+
+    # 2. The first user renames themselves; the second takes the freed username
+    print("2. Handing the first username over to the second user...")
+    requests.patch(f"{BASE_URL}/users/{ids[0]}", json={"username": f"old_{suffix}"}, headers=headers[0])
+    response = requests.patch(f"{BASE_URL}/users/{ids[1]}", json={"username": first["username"]}, headers=headers[1])
+    if response.status_code == 200:
+        print("✅ Username changed hands")
+    else:
+        print(f"❌ Failed to rename: {response.text}")
+        return
+
+    print("\n" + "="*50 + "\n")
+
+    # 3. The first user's token must not reach the second user's account
+    print("3. Using the first user's token on the second user's profile (should fail)...")
+    response = requests.patch(f"{BASE_URL}/users/{ids[1]}", json={"nickname": "Hijacked"}, headers=headers[0])
+    if response.status_code in (401, 403):
+        print("✅ Correctly rejected - the token still belongs to the first user!")
+    else:
+        print(f"❌ Unexpected response: {response.status_code}")
+
+def test_refresh_tokens():
+    """Refresh tokens rotate on use; reuse or logout ends the login session"""
+
+    print("🔐 Testing Refresh Token Rotation\n")
+
+    suffix = uuid.uuid4().hex[:8]
+    user_data = {"username": f"refresh_{suffix}", "email": f"refresh_{suffix}@example.com", "password": "securepassword123"}
+    credentials = {"username": user_data["username"], "password": user_data["password"]}
+
+    # 1. Create a user and log in
+    print("1. Creating a user and logging in...")
+    response = requests.post(f"{BASE_URL}/users/", json=user_data)
+    if response.status_code != 201:
+        print(f"❌ Failed to create user: {response.text}")
+        return
+    user_id = response.json()["id"]
+    response = requests.post(f"{BASE_URL}/auth/login", json=credentials)
+    if response.status_code != 200 or not response.json().get("refresh_token"):
+        print(f"❌ Login did not return a refresh token: {response.text}")
+        return
+    first_refresh = response.json()["refresh_token"]
+    print("✅ Logged in with a refresh token")
+
+    print("\n" + "="*50 + "\n")
+
+    # 2. Trade the refresh token for new tokens
+    print("2. Refreshing the session...")
+    response = requests.post(f"{BASE_URL}/auth/refresh", json={"refresh_token": first_refresh})
+    if response.status_code != 200:
+        print(f"❌ Refresh failed: {response.text}")
+        return
+    second_refresh = response.json()["refresh_token"]
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    response = requests.get(f"{BASE_URL}/users/{user_id}", headers=headers)
+    if second_refresh != first_refresh and response.status_code == 200:
+        print("✅ Got a new refresh token and a working access token")
+    else:
+        print(f"❌ Refreshed tokens did not work: {response.status_code}")
+        return
+
+    print("\n" + "="*50 + "\n")
+
+    # 3. Presenting the used refresh token again must fail...
+    print("3. Reusing the old refresh token (should fail)...")
+    response = requests.post(f"{BASE_URL}/auth/refresh", json={"refresh_token": first_refresh})
+    if response.status_code == 401:
+        print("✅ Correctly rejected - refresh tokens work only once!")
+    else:
+        print(f"❌ Unexpected response: {response.status_code}")
+
+    # ...and revoke the whole session, including the tokens it was rotated into
+    print("   Using the rotated tokens after the reuse (should fail)...")
+    response = requests.post(f"{BASE_URL}/auth/refresh", json={"refresh_token": second_refresh})
+    access = requests.get(f"{BASE_URL}/users/{user_id}", headers=headers)
+    if response.status_code == 401 and access.status_code == 401:
+        print("✅ Correctly rejected - the reuse revoked the session!")
+    else:
+        print(f"❌ Unexpected responses: refresh {response.status_code}, access {access.status_code}")
+
+    print("\n" + "="*50 + "\n")
+
+    # 4. Logging out ends the session's refresh tokens too
+    print("4. Logging in again, logging out, then refreshing (should fail)...")
+    response = requests.post(f"{BASE_URL}/auth/login", json=credentials)
+    if response.status_code != 200:
+        print(f"❌ Login failed: {response.text}")
+        return
+    refresh_token = response.json()["refresh_token"]
+    headers = {"Authorization": f"Bearer {response.json()['access_token']}"}
+    requests.post(f"{BASE_URL}/auth/logout", headers=headers)
+    response = requests.post(f"{BASE_URL}/auth/refresh", json={"refresh_token": refresh_token})
+    if response.status_code == 401:
+        print("✅ Correctly rejected - logout ended the refresh token!")
+    else:
+        print(f"❌ Unexpected response: {response.status_code}")
+
+def test_login_rate_limit():
+    """Repeated failed logins for one username are answered with 429 and Retry-After"""
+
+    print("🔐 Testing Login Rate Limiting\n")
+
+    suffix = uuid.uuid4().hex[:8]
+    user_data = {"username": f"limited_{suffix}", "email": f"limited_{suffix}@example.com", "password": "securepassword123"}
+    response = requests.post(f"{BASE_URL}/users/", json=user_data)
+    if response.status_code != 201:
+        print(f"❌ Failed to create user: {response.text}")
+        return
+
+    # 1. Fail until the username's bucket (LOGIN_USER_BURST, default 5) runs out
+    print("1. Sending wrong passwords until the server pushes back...")
+    wrong = {"username": user_data["username"], "password": "wrong-password"}
+    for attempt in range(1, 21):
+        response = requests.post(f"{BASE_URL}/auth/login", json=wrong)
+        if response.status_code != 401:
+            break
+    if response.status_code == 429 and response.headers.get("Retry-After", "").isdigit():
+        print(f"✅ Throttled after {attempt - 1} failures, Retry-After: {response.headers['Retry-After']}s")
+    else:
+        print(f"❌ Unexpected response: {response.status_code} (is LOGIN_USER_PER_MINUTE=0?)")
+        return
+
+    print("\n" + "="*50 + "\n")
+
+    # 2. The right password is throttled too until the bucket refills
+    print("2. Logging in with the right password while throttled (should fail)...")
+    response = requests.post(f"{BASE_URL}/auth/login", json={"username": user_data["username"], "password": user_data["password"]})
+    if response.status_code == 429:
+        print("✅ Correctly throttled - guesses cannot continue with the real password either!")
+    else:
+        print(f"❌ Unexpected response: {response.status_code}")
+
 if __name__ == "__main__":
     print("🚀 Starting Authentication Test")
     print("Make sure your API is running on http://localhost:8000")
@@ -123,6 +282,12 @@ if __name__ == "__main__":
     
     try:
         test_authentication_flow()
+        print("\n" + "="*50 + "\n")
+        test_renamed_username()
+        print("\n" + "="*50 + "\n")
+        test_refresh_tokens()
+        print("\n" + "="*50 + "\n")
+        test_login_rate_limit()
     except requests.exceptions.ConnectionError:
         print("❌ Could not connect to the API. Make sure it's running on http://localhost:8000")
     except Exception as e:
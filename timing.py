@@ -0,0 +1,126 @@
+import os
+import time
+from collections import Counter
+from contextlib import contextmanager
+from contextvars import ContextVar
+from typing import Optional
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+# Per-request SQL and auth timing, reported in the Server-Timing header
+SERVER_TIMING = os.getenv("SERVER_TIMING", "true").lower() in ("1", "true", "yes", "on")
+# Print one line per request with its query count and timings
+SQL_TIMING_LOG = os.getenv("SQL_TIMING_LOG", "false").lower() in ("1", "true", "yes", "on")
+# Record every statement and warn when one repeats within a request (likely N+1)
+SQL_TIMING_DEBUG = os.getenv("SQL_TIMING_DEBUG", "false").lower() in ("1", "true", "yes", "on")
+SQL_REPEAT_THRESHOLD = int(os.getenv("SQL_REPEAT_THRESHOLD", "3"))
+
+ENABLED = SERVER_TIMING or SQL_TIMING_LOG or SQL_TIMING_DEBUG
+
+class RequestTiming:
+    """Query count and time spent per phase for one request"""
+
+    __slots__ = ("start", "queries", "db", "auth", "statements")
+
+    def __init__(self):
+        self.start = time.perf_counter()
+        self.queries = 0
+        self.db = 0.0
+        self.auth = 0.0
+        self.statements = Counter() if SQL_TIMING_DEBUG else None
+
+    def repeated(self) -> dict:
+        """Statements issued at least SQL_REPEAT_THRESHOLD times"""
+        if self.statements is None:
+            return {}
+        return {sql: count for sql, count in self.statements.items() if count >= SQL_REPEAT_THRESHOLD}
+
+    def server_timing(self) -> str:
+        total = time.perf_counter() - self.start
+        return (
+            f'db;dur={self.db * 1000:.2f};desc="{self.queries} queries", '
+            f"auth;dur={self.auth * 1000:.2f}, "
+            f"total;dur={total * 1000:.2f}"
+        )
+
+# The object is shared by reference, so statements run in the threadpool
+# (sync path) or a greenlet (async path) update the request's totals
+_current: ContextVar[Optional[RequestTiming]] = ContextVar("request_timing", default=None)
+
+@contextmanager
+def measure_auth():
+    """Add the time spent in the block to the request's auth total"""
+    timing = _current.get()
+    if timing is None:
+        yield
+        return
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        timing.auth += time.perf_counter() - start
+
+def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    if _current.get() is not None:
+        conn.info.setdefault("query_start", []).append(time.perf_counter())
+
+def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    timing = _current.get()
+    if timing is None:
+        return
+    starts = conn.info.get("query_start")
+    if not starts:
+        return
+    timing.db += time.perf_counter() - starts.pop()
+    timing.queries += 1
+    if timing.statements is not None:
+        timing.statements[statement] += 1
+
+def install():
+    """Listen on every Engine, including ones created later (replicas, lazily built engines)"""
+    if ENABLED and not event.contains(Engine, "before_cursor_execute", _before_cursor_execute):
+        event.listen(Engine, "before_cursor_execute", _before_cursor_execute)
+        event.listen(Engine, "after_cursor_execute", _after_cursor_execute)
+
+def _report(scope, status_code: int, timing: RequestTiming):
+    route = getattr(scope.get("route"), "path", scope["path"])
+    if SQL_TIMING_LOG:
+        print(
+            f"SQL: {scope['method']} {route} {status_code} queries={timing.queries} "
+            f"db={timing.db * 1000:.2f}ms auth={timing.auth * 1000:.2f}ms"
+        )
+    for statement, count in timing.repeated().items():
+        print(f"WARNING: possible N+1 in {scope['method']} {route}: {count}x {' '.join(statement.split())}")
+
+class ServerTimingMiddleware:
+    """ASGI middleware that tracks SQL and auth time per request"""
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http" or not ENABLED:
+            await self.app(scope, receive, send)
+            return
+
+        timing = RequestTiming()
+        token = _current.set(timing)
+        status_code = 500
+
+        async def send_wrapper(message):
+            nonlocal status_code
+            if message["type"] == "http.response.start":
+                status_code = message["status"]
+                if SERVER_TIMING:
+                    message["headers"] = [
+                        *message.get("headers", []),
+                        (b"server-timing", timing.server_timing().encode("latin-1")),
+                    ]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            _current.reset(token)
+            if SQL_TIMING_LOG or SQL_TIMING_DEBUG:
+                _report(scope, status_code, timing)